@@ -0,0 +1,96 @@
+"""
+Detecting the pattern in a large set of stored images (eg. for an offline calibration)
+is limited by the corner detection, so the images are spread across a pool of processes.
+"""
+import copy
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+
+# The pattern used by this worker process. It is sent to each worker once when the pool starts
+# rather than being pickled along with every image.
+_worker_pattern = None
+
+def _init_worker(pattern, single_threaded=True):
+    global _worker_pattern
+    # Work on a copy, so that the settings below don't change the caller's pattern (when detecting in-process)
+    _worker_pattern = copy.copy(pattern)
+    # The images in a batch are not consecutive frames, so there is nothing to track
+    _worker_pattern.tracker = None
+    # Nothing is waiting on an individual image, so there's no reason to abandon slow detections
+    _worker_pattern.detection_timeout = None
+    if single_threaded:
+        # Each process is already busy, so don't let OpenCV start more threads than there are cores
+        cv2.setNumThreads(1)
+
+def _detect_one(image_or_path):
+    """
+    Loads the image (if given a path) and detects the pattern.
+    Returns the full-resolution corners as an (n_points, 2) float32 array, or None if the pattern was not found.
+    """
+    cache_key = None
+    if isinstance(image_or_path, (str, os.PathLike)):
+        try:
+            data = np.fromfile(os.fspath(image_or_path), dtype=np.uint8)
+        except OSError as e:
+            # One missing file shouldn't throw away the rest of the batch, so it counts as a miss
+            print(f"Warning: could not read image {image_or_path}: {e}")
+            return None
+        if _worker_pattern.cache is not None:
+            # Key on the encoded file so that cache hits don't need to decode the image at all
+            cache_key = _worker_pattern.cache.key(data, _worker_pattern)
+            hit, corners = _worker_pattern.cache.get(cache_key)
+            if hit:
+                return None if corners is None else corners.reshape(-1, 2)
+        image = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            print(f"Warning: could not read image {image_or_path}")
+            return None
+    else:
+        image = image_or_path
+    _, corners, _, _ = _worker_pattern.detect(image, cache_key=cache_key)
+    if corners is None:
+        return None
+    return corners.reshape(-1, 2)
+
+def detect_batch(pattern, images_or_paths, workers=None, chunksize=4, verbose=True):
+    """
+    Detects the pattern in every image (or image file) using a pool of worker processes.
+    workers defaults to the number of CPUs; with workers=1 the detection runs in this process.
+
+    Returns (found, corners) in the same order as the input, where found is a boolean array of shape (n_images,)
+    and corners is a float32 array of shape (n_images, n_points, 2) that is NaN for the images without a detection.
+    """
+    images_or_paths = list(images_or_paths)
+    n_images = len(images_or_paths)
+    n_points = pattern.n_rows * pattern.n_cols
+    found = np.zeros(n_images, dtype=bool)
+    corners = np.full((n_images, n_points, 2), np.nan, dtype=np.float32)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        _init_worker(pattern, single_threaded=False)
+        results = map(_detect_one, images_or_paths)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(pattern,))
+        results = executor.map(_detect_one, images_or_paths, chunksize=chunksize)
+
+    try:
+        for i, points in enumerate(results):
+            if points is not None:
+                found[i] = True
+                corners[i] = points
+            if verbose:
+                print(f"\rDetected the pattern in {np.count_nonzero(found)}/{i + 1} of {n_images} images", end="", file=sys.stderr)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if verbose:
+            print(file=sys.stderr)
+
+    return found, corners
@@ -0,0 +1,83 @@
+"""
+Solving hundreds of views can take tens of seconds, so calibrate_async runs the calibration on a worker thread
+(OpenCV releases the GIL while it solves, so the GUI keeps running) and returns a CalibrationJob to follow it.
+The solver reports its progress to the job between steps, which is also where a cancelled job stops.
+"""
+import threading
+import time
+from concurrent.futures import Future
+
+class CalibrationCancelled(Exception):
+    pass
+
+class CalibrationJob:
+    """
+    A calibration running in the background: a Future for its result, along with its progress.
+    Cancelling the job stops the calibration at its next step, without changing the calibrator.
+    """
+    def __init__(self):
+        self.future = Future()
+        self.stage = "waiting" # a description of what the calibration is doing
+        self.progress = 0.0 # approximate fraction of the calibration that is done
+        self.start_time = None
+        self.end_time = None
+        self._cancel_requested = threading.Event()
+
+    def report(self, stage, progress):
+        """
+        Called by the calibration between steps. Raises CalibrationCancelled if the job was cancelled.
+        """
+        if self._cancel_requested.is_set():
+            raise CalibrationCancelled()
+        self.stage = stage
+        self.progress = progress
+
+    def run(self, calibrate):
+        """
+        Runs calibrate(job) (on the worker thread) and resolves the future with its result.
+        """
+        if not self.future.set_running_or_notify_cancel():
+            return
+        self.start_time = time.perf_counter()
+        try:
+            self.report("starting", 0.0)
+            result = calibrate(self)
+        except CalibrationCancelled:
+            self.stage = "cancelled"
+            self.future.set_exception(CalibrationCancelled())
+        except Exception as e:
+            self.stage = "failed"
+            self.future.set_exception(e)
+        else:
+            self.stage = "done"
+            self.progress = 1.0
+            self.future.set_result(result)
+        finally:
+            self.end_time = time.perf_counter()
+
+    def cancel(self):
+        """
+        Cancels the job: a job that hasn't started won't run, and a running job stops at its next step.
+        """
+        self._cancel_requested.set()
+        self.future.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancel_requested.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    @property
+    def elapsed(self):
+        """
+        Seconds since the calibration started (or how long it took, once it is done).
+        """
+        if self.start_time is None:
+            return 0.0
+        end = self.end_time if self.end_time is not None else time.perf_counter()
+        return end - self.start_time
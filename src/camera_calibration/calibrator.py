@@ -1,10 +1,88 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 from abc import ABC, abstractmethod
 from camera_calibration.intrinsic_parameters import IntrinsicParameters
-from camera_calibration.sample import MonoSample, StereoSample, HandEyeSample
+from camera_calibration.sample import MonoSample, StereoSample, HandEyeSample, FileImage
+from camera_calibration.sample_store import SampleStore
+from camera_calibration.spatial_index import GridIndex
+from camera_calibration.coverage import CoverageAccumulator
+from camera_calibration.calibration_job import CalibrationJob
+from camera_calibration.view_selection import select_views
+from camera_calibration.image_retention import CompressedImage
+from camera_calibration.frame_buffer import BorrowedFrame, wrap_buffer, own
 from camera_calibration.enums import CameraModel
 
+def _get_outside_corners(corners, pattern):
+    """
+    Return the four corners of the board as a whole, as (up_left, up_right, down_right, down_left).
+    """
+    if len(corners) == pattern.n_rows * pattern.n_cols:
+        return (corners[0], corners[pattern.n_cols - 1], corners[-1], corners[-pattern.n_cols])
+    # For a partial detection the grid corners are unknown, so use the bounding rectangle of the points
+    up_left, up_right, down_right, down_left = cv2.boxPoints(cv2.minAreaRect(corners))
+    return (up_left, up_right, down_right, down_left)
+
+def _calculate_skew(corners):
+    """
+    Get skew for given checkerboard detection.
+    Scaled to [0,1], which 0 = no skew, 1 = high skew
+    Skew is proportional to the divergence of three outside corners from 90 degrees.
+    """
+    up_left, up_right, down_right, _ = corners
+    ab = up_left - up_right
+    cb = down_right - up_right
+    angle = math.acos(np.clip(np.dot(ab, cb) / (np.linalg.norm(ab) * np.linalg.norm(cb)), -1.0, 1.0))
+    return min(1.0, 2. * abs((math.pi / 2.) - angle))
+
+def _calculate_area(corners):
+    """
+    Get 2d image area of the detected checkerboard.
+    The projected checkerboard is assumed to be a convex quadrilateral, and the area computed as
+    |p X q|/2; see http://mathworld.wolfram.com/Quadrilateral.html.
+    """
+    (up_left, up_right, down_right, down_left) = corners
+    a = up_right - up_left
+    b = down_right - up_right
+    c = down_left - down_right
+    p = b + c
+    q = a + b
+    return abs(p[0]*q[1] - p[1]*q[0]) / 2.
+
+def get_parameters(corners, pattern, image_size):
+    """
+    Return the parameters [X, Y, size, skew] (each in [0, 1]) describing the view of the pattern, as in image_pipeline.
+    """
+    (width, height) = image_size
+    corners = np.asarray(corners, dtype=np.float32).reshape(-1, 2)
+    outside_corners = _get_outside_corners(corners, pattern)
+    area = _calculate_area(outside_corners)
+    skew = _calculate_skew(outside_corners)
+    border = math.sqrt(area)
+    # For X and Y, we "shrink" the image all around by approx. half the board size.
+    # Otherwise large boards are penalized because you can't get much X/Y variation.
+    mean_x, mean_y = corners.mean(axis=0)
+    p_x = min(1.0, max(0.0, (mean_x - border / 2) / max(width - border, 1.0)))
+    p_y = min(1.0, max(0.0, (mean_y - border / 2) / max(height - border, 1.0)))
+    p_size = math.sqrt(area / (width * height))
+    return np.array([p_x, p_y, p_size, skew], dtype=np.float32)
+
+def _replace_image(sample, image):
+    """
+    Replaces the image of a sample (eg. with a compressed or spooled version), keeping the downsampled levels
+    of its pyramid, which are shown right away, but not its full-resolution images.
+    """
+    cached = getattr(sample, '_pyramid', None)
+    sample.image = image
+    if cached is not None:
+        pyramid = cached[1]
+        pyramid.release_image(lambda: sample.image)
+        sample._pyramid = (sample.raw_image(), pyramid)
+
 class Calibrator(ABC):
     """
     A calibrator manages the collection of samples, 
@@ -12,20 +90,38 @@ class Calibrator(ABC):
     running the calibration itself, 
     and saving the samples and calibration output to a file.
     """
-    def __init__(self, camera_model: CameraModel):
+    def __init__(self, camera_model: CameraModel, pattern=None):
         self.auto_collect = True
 
         self.camera_model = camera_model
-        self.samples = []
+        self.pattern = pattern # the Pattern used to detect the sample points
+        # Set max_samples to bound the number of samples; when the store is full, the sample that contributes
+        # least to the coverage of the views is evicted (see SampleStore.least_valuable)
+        self.samples = SampleStore(None if pattern is None else pattern.n_rows * pattern.n_cols)
+        self.max_samples = None
+        self.sample = None # the most recent sample, which is added when collecting manually
         self.n_points = 0
+        self.image_size = None # (width, height), taken from the first sample
+
+        # A new view is rejected if its parameters are within this (L1) distance of a stored sample's.
+        # The stored parameters are kept in a grid hash, so the check is independent of the number of samples.
+        self.min_param_distance = 0.2
+        self.param_index = GridIndex(n_dims=4, cell_size=self.min_param_distance)
+        self.spool = None # set to an ImageSpool to keep the images of accepted samples on disk rather than in memory
+        self.retention = None # set to a CompressedRetention to only keep the (losslessly) compressed images of accepted samples
+        self.output_path = "calibration_data" # where save() writes to by default
+        self.journal = None # set to a SessionJournal to write each accepted sample to disk as it arrives
+        self._journal_ids = {} # id(sample) -> the sample's id in the journal
+        self._last_added = None # the most recently added sample, whose downsampled images may still be shown
+        self._calibration_executor = None # runs calibrate_async jobs
 
         # distribution requirements
         self.min_n_points = 500 # the minimum number of image points
-        self.min_n_points_per_bin = 3 # the minimum number of points in each bin
         self.min_scale_range_px = 100 # the difference between the span of the smallest and largest samples in the image 
         self.min_skew_range_deg = 10 # the difference between the angle of the smallest and largest samples in the image
-        self.xy_bin_count = np.zeros((2,3)) # 2D histogram of the x and y coordinates of the samples
-        # TODO: resize the number of bins to be a function of the image size
+        # Histogram of the point positions (with bins scaled to the image size) and the ranges of the view sizes and skews,
+        # updated as samples are added and removed. The minimum number of points in each bin is coverage.min_points_per_bin.
+        self.coverage = CoverageAccumulator(min_points_per_bin=3)
     
     @abstractmethod
     def maybe_add_sample(self, sample):
@@ -46,13 +142,36 @@ class Calibrator(ABC):
         pass
 
     @abstractmethod
-    def calibrate(self, force=False):
+    def calibrate(self, force=False, job=None):
         """
         Runs the OpenCV camera calibration function.
         If force is True, the calibration will run even if the distribution is not good.
+        If job (a CalibrationJob) is given, progress is reported to it, and the calibration stops if it is cancelled.
         """
         pass
 
+    def calibrate_async(self, force=False):
+        """
+        Runs the calibration on a worker thread and returns its CalibrationJob, which can be polled for progress or cancelled.
+        The samples are read (see prepare_calibration) before this returns, so samples may be added and removed while it runs.
+        Returns None (without starting a job) if the calibration is skipped.
+        """
+        calibrate = self.prepare_calibration(force)
+        if calibrate is None:
+            return None
+        job = CalibrationJob()
+        if self._calibration_executor is None:
+            self._calibration_executor = ThreadPoolExecutor(max_workers=1)
+        self._calibration_executor.submit(job.run, calibrate)
+        return job
+
+    def prepare_calibration(self, force=False):
+        """
+        Takes what the calibration needs from the samples (on the calling thread), and returns a function
+        calibrate(job) that runs the calibration from that snapshot, or None if the calibration is skipped.
+        """
+        return lambda job: self.calibrate(force, job)
+
     @abstractmethod
     def print_calibration_results(self):
         """
@@ -86,105 +205,579 @@ class Calibrator(ABC):
         print(f"Auto-collect is now {'on' if self.auto_collect else 'off'}")
 
     def collect_sample(self):
-        if self.auto_collect:
-            self.maybe_add_sample(self.sample)
+        if self.sample is not None:
+            self.add_sample(self.sample)
+
+    def add_sample(self, sample, params=None):
+        """
+        Adds a sample with detected points to the calibrator.
+        params are the sample's view parameters (see get_parameters), which are computed if not given.
+        Returns False if the sample was not kept (because it wasn't detected, or because the store is
+        full and the sample would add the least coverage).
+        """
+        if sample.pixel_points is None:
+            print("The pattern was not detected in the most recent sample, so it was not added")
+            return False
+        if params is None:
+            params = self.view_parameters(sample)
+
+        index = self.samples.append(sample, params=params)
+        self.n_points += len(sample.pixel_points)
+        if params is not None:
+            self.param_index.insert(id(sample), params)
+        self._update_coverage(sample.pixel_points, params)
+        if self.max_samples is not None and len(self.samples) > self.max_samples:
+            evicted = self.samples.least_valuable()
+            self.remove_sample(evicted)
+            if evicted == index:
+                return False
+
+        if isinstance(sample.raw_image(), np.ndarray):
+            # Frames from ingest are views of the caller's buffer, which is only copied now that the frame is kept
+            image = own(sample.raw_image())
+            if image is not sample.raw_image():
+                _replace_image(sample, image)
+        if sample.raw_image() is not None:
+            if self.retention is not None:
+                _replace_image(sample, self.retention.retain(sample.image))
+            elif self.spool is not None:
+                _replace_image(sample, self.spool.put(sample.image))
+        if self.journal is not None:
+            self._journal_ids[id(sample)] = self.journal.record_sample(sample, params, self.image_size)
+        # Only the current frame is shown, so the downsampled images of the previously added sample aren't needed anymore
+        previous, self._last_added = self._last_added, sample
+        cached = getattr(previous, '_pyramid', None)
+        if cached is not None and previous is not sample:
+            cached[1].release_levels()
+        return True
+
+    def ingest(self, buffer, shape=None, strides=None, dtype=None, offset=0):
+        """
+        Processes a frame given as any object supporting the buffer protocol (see frame_buffer.wrap_buffer for
+        how its layout is determined). The buffer is used in place, and only copied if the frame is kept as a sample,
+        so it may be reused by the caller once ingest returns.
+        """
+        self.maybe_add_sample(MonoSample(wrap_buffer(buffer, shape, strides, dtype, offset)))
+        self._release_borrowed_sample()
+
+    def _release_borrowed_sample(self):
+        """
+        Makes sure that the most recent sample doesn't refer to a buffer that the caller may reuse once ingest returns:
+        it is copied if it may still be collected manually, and otherwise forgotten.
+        """
+        sample = self.sample
+        if sample is None or not isinstance(sample.raw_image(), BorrowedFrame):
+            return
+        if not self.auto_collect and sample.pixel_points is not None:
+            _replace_image(sample, own(sample.raw_image()))
+        else:
+            self.sample = None
+
+    def resume(self, journal):
+        """
+        Rebuilds the samples of a previous session from its SessionJournal, without detecting anything again.
+        The images are only read from the journal if they are used.
+        """
+        n_samples = 0
+        for sample, params, image_size, record_id in journal.load_samples(self.pattern):
+            self._restore_sample(sample, params, image_size)
+            self._journal_ids[id(sample)] = record_id
+            n_samples += 1
+        print(f"Resumed {n_samples} samples from {journal.directory}")
+
+    def _restore_sample(self, sample, params, image_size):
+        """
+        Adds a previously accepted sample (eg. loaded from disk) as-is: it isn't checked, evicted, retained or journaled.
+        """
+        if self.image_size is None and image_size is not None:
+            self.image_size = image_size
+        self.samples.append(sample, params=params)
+        self.n_points += len(sample.pixel_points)
+        if params is not None:
+            self.param_index.insert(id(sample), params)
+        self._update_coverage(sample.pixel_points, params)
+
+    def _update_coverage(self, pixel_points, params, remove=False):
+        if self.image_size is None:
+            return
+        if self.coverage.image_size is None:
+            self.coverage.set_image_size(self.image_size)
+        if remove:
+            self.coverage.remove(pixel_points, params)
+        else:
+            self.coverage.add(pixel_points, params)
+
+    def remove_sample(self, index):
+        """
+        Removes the sample at index and returns it.
+        """
+        params = self.samples.params[index]
+        params = None if np.isnan(params).any() else params.copy()
+        sample = self.samples.remove(index)
+        self.n_points -= len(sample.pixel_points)
+        self.param_index.remove(id(sample))
+        self._update_coverage(sample.pixel_points, params, remove=True)
+        record_id = self._journal_ids.pop(id(sample), None)
+        if self.journal is not None and record_id is not None:
+            self.journal.record_removal(record_id)
+        return sample
+
+    def refine_samples(self, workers=None):
+        """
+        Refines the pixel points of the stored samples (see Pattern.refine_samples) and writes them back to the store,
+        which is what calibrate uses. The samples' images are needed, so this loads them if they are lazy.
+        """
+        samples = list(self.samples)
+        old_points = [sample.pixel_points for sample in samples]
+        self.pattern.refine_samples(samples, workers)
+        for index, (sample, points) in enumerate(zip(samples, old_points)):
+            self.samples.update_points(index, sample.pixel_points)
+            params = self.samples.params[index]
+            params = None if np.isnan(params).any() else params.copy()
+            self._update_coverage(points, params, remove=True)
+            self._update_coverage(sample.pixel_points, params)
+
+    def view_parameters(self, sample):
+        """
+        Returns the view parameters [X, Y, size, skew] of a sample with detected points (see get_parameters).
+        """
+        if self.image_size is None:
+            height, width = sample.image.shape[:2]
+            self.image_size = (width, height)
+        if self.pattern is None:
+            return None
+        return get_parameters(sample.pixel_points, self.pattern, self.image_size)
+
+    def is_good_sample(self, params):
+        """
+        Returns True if the view described by params is far enough from every stored sample to be worth adding.
+        """
+        if params is None:
+            return True
+        distance, _ = self.param_index.nearest(params, self.min_param_distance)
+        return distance > self.min_param_distance
 
     def close(self):
         self.save()
+        if self.journal is not None:
+            self.journal.close()
+        # The images of the samples are no longer needed once they are saved (and journaled)
+        if self.retention is not None:
+            self.retention.close()
+        if self.spool is not None:
+            self.spool.close()
         # TODO: how does this propagate back to the CLI?
 
 
 class IntrinsicCalibrator(Calibrator):
-    def __init__(self, camera_model: CameraModel):
-        super().__init__(camera_model)
+    def __init__(self, camera_model: CameraModel, pattern=None):
+        super().__init__(camera_model, pattern)
         self.gui = None
 
+        self.intrinsics = None # the latest IntrinsicParameters (from calibrate or a background solve), which warm-start the next solve
+        self.intrinsics_n_samples = 0 # the number of samples the latest intrinsics were solved from
+        # In background calibration, each accepted sample triggers a (warm-started) solve in a background thread,
+        # so that the latest intrinsics and RMS are always available. Solves are coalesced: while one runs,
+        # only the newest set of samples is queued.
+        self.background_calibration = False
+        self.min_background_samples = 3
+        # When calibrating with a CalibrationJob, the solver runs in steps of a few iterations (each warm-started
+        # from the last), so that progress can be reported and the job cancelled between them
+        self.iterations_per_step = 5
+        self.max_steps = 10
+        # Set max_views to calibrate on at most this many views, selected for their coverage (see view_selection);
+        # compare_view_subsets shows what a given max_views costs in accuracy and saves in time
+        self.max_views = None
+        # In robust mode, calibrate drops the views whose reprojection error is an outlier (see _solve_robust)
+        self.robust = False
+        self.outlier_mad_k = 3.0
+        self.max_robust_rounds = 10 # solves, including the final one on the kept views
+        self.min_outlier_mad_fraction = 0.1 # the MAD is at least this fraction of the median error
+        self.min_robust_views = 3 # views aren't dropped if fewer than this would be left
+        self.n_background_solves = 0
+        self._solve_lock = threading.Lock()
+        self._pending_solve = None # (object_points, image_points, generation) for the next background solve
+        self._solving = False
+        # Counts the foreground calibrations, so that a background solve of samples read before the latest
+        # foreground calibration doesn't replace its result
+        self._generation = 0
+        self._solve_executor = None
+
+    def detect(self, sample: MonoSample):
+        """
+        Detects the pattern points in the sample (if they haven't been detected already).
+        Detection uses the sample's shared grayscale and downsampled images.
+        """
+        if sample.pixel_points is None and self.pattern is not None:
+            _, sample.pixel_points, _, _ = self.pattern.detect(sample.pyramid)
+            if sample.pixel_points is not None:
+                sample.pattern = self.pattern
+
     def maybe_add_sample(self, sample: MonoSample):
         """
         Adds a sample to the calibrator if it improves the distribution of the samples.
         """
+        self.detect(sample)
+        self.sample = sample
+        if self.auto_collect and sample.pixel_points is not None:
+            params = self.view_parameters(sample)
+            if self.is_good_sample(params):
+                self.add_sample(sample, params)
         self.gui.show(sample)
 
+    def add_sample(self, sample, params=None):
+        added = super().add_sample(sample, params)
+        if added and self.background_calibration and len(self.samples) >= self.min_background_samples:
+            self._schedule_background_solve()
+        return added
+
+    def _calibration_points(self, indices=None):
+        """
+        Returns the (object_points, image_points) of the samples (or only the given samples), as needed by cv2.calibrateCamera.
+        """
+        if indices is None:
+            indices = range(len(self.samples))
+        # The image points are views into the sample store, and the object points are (views of) the
+        # pattern's shared template, so neither needs to be copied
+        image_points = self.samples.image_points(indices) # 2D points in image plane
+        object_points = [self.samples[i].world_points.reshape(-1, 1, 3) for i in indices] # 3D points in real world space
+        return object_points, image_points
+
+    def select_views(self, max_views):
+        """
+        Returns the indices of at most max_views samples that best cover the image, board sizes and tilts.
+        """
+        return select_views(self.samples.image_points(), self.samples.params, self.image_size, max_views)
+
+    def reprojection_rms(self, intrinsics, indices=None):
+        """
+        Returns the RMS reprojection error (in pixels) of the samples (or only the given samples) under the given
+        intrinsics, with each view's pose estimated by solvePnP. This measures intrinsics solved from a subset of
+        the views on all of them.
+        """
+        object_points, image_points = self._calibration_points(indices)
+        camera_matrix = intrinsics.camera_matrix
+        dist_coeffs = np.array(intrinsics.distortion_coefficients, dtype=np.float64)
+        squared_error, n = 0.0, 0
+        for object_view, image_view in zip(object_points, image_points):
+            object_view = object_view.astype(np.float64)
+            image_view = image_view.astype(np.float64)
+            if self.camera_model == CameraModel.FISHEYE:
+                undistorted = cv2.fisheye.undistortPoints(image_view, camera_matrix, dist_coeffs)
+                _, rvec, tvec = cv2.solvePnP(object_view, undistorted, np.eye(3), None)
+                projected, _ = cv2.fisheye.projectPoints(object_view, rvec, tvec, camera_matrix, dist_coeffs)
+            else:
+                _, rvec, tvec = cv2.solvePnP(object_view, image_view, camera_matrix, dist_coeffs)
+                projected, _ = cv2.projectPoints(object_view, rvec, tvec, camera_matrix, dist_coeffs)
+            squared_error += np.sum((projected.reshape(-1, 2) - image_view.reshape(-1, 2)) ** 2)
+            n += len(image_view)
+        return math.sqrt(squared_error / max(n, 1))
+
+    def compare_view_subsets(self, view_counts):
+        """
+        Calibrates (from scratch) on all the samples and on coverage-selected subsets of each size in view_counts,
+        and prints the solve time, the RMS error over all the samples and the change of the intrinsics for each,
+        to help choose max_views. Returns a list of dicts with the same numbers, the full set first.
+        """
+        object_points, image_points = self._calibration_points()
+        start = time.perf_counter()
+        full = self._solve(object_points, image_points)
+        full_time = time.perf_counter() - start
+        # The RMS of every row is measured the same way (see reprojection_rms), rather than taken from calibrateCamera
+        results = [{"n_views": len(image_points), "time": full_time, "rms": self.reprojection_rms(full),
+                    "d_fx": 0.0, "d_fy": 0.0, "d_cx": 0.0, "d_cy": 0.0}]
+        for max_views in sorted(view_counts, reverse=True):
+            if max_views >= len(self.samples):
+                continue
+            start = time.perf_counter()
+            indices = self.select_views(max_views)
+            subset = self._solve(*self._calibration_points(indices))
+            results.append({"n_views": len(indices), "time": time.perf_counter() - start,
+                            "rms": self.reprojection_rms(subset),
+                            "d_fx": subset.fx - full.fx, "d_fy": subset.fy - full.fy,
+                            "d_cx": subset.cx - full.cx, "d_cy": subset.cy - full.cy})
+
+        print(f"{'views':>6} {'time (s)':>9} {'RMS (px)':>9} {'dfx':>8} {'dfy':>8} {'dcx':>8} {'dcy':>8}")
+        for r in results:
+            print(f"{r['n_views']:>6} {r['time']:>9.3f} {r['rms']:>9.4f} {r['d_fx']:>8.2f} {r['d_fy']:>8.2f} "
+                  f"{r['d_cx']:>8.2f} {r['d_cy']:>8.2f}")
+        return results
+
+    def _solve(self, object_points, image_points, guess=None, job=None):
+        """
+        Calibrates from the given points, starting from the guess (IntrinsicParameters) if there is one,
+        and returns the resulting IntrinsicParameters. With a job, the solve runs in steps (see iterations_per_step).
+        """
+        if job is None:
+            return self._solve_step(object_points, image_points, guess)
+        intrinsics = guess
+        previous_rms = None
+        for step in range(self.max_steps):
+            job.report(f"solving {len(image_points)} samples", step / self.max_steps)
+            intrinsics = self._solve_step(object_points, image_points, intrinsics, self.iterations_per_step)
+            if previous_rms is not None and abs(previous_rms - intrinsics.rms) <= 1e-6 * previous_rms:
+                break
+            previous_rms = intrinsics.rms
+        return intrinsics
+
+    def _solve_step(self, object_points, image_points, guess=None, max_iterations=None, per_view_errors=False):
+        """
+        Runs one solve (of at most max_iterations). If per_view_errors is True, returns
+        (intrinsics, errors) with the RMS reprojection error of each view.
+        """
+        if self.camera_model == CameraModel.FISHEYE:
+            flags = cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC
+            camera_matrix, dist_coeffs = np.eye(3), np.zeros(4)
+            if guess is not None:
+                flags |= cv2.fisheye.CALIB_USE_INTRINSIC_GUESS
+                camera_matrix, dist_coeffs = guess.camera_matrix, np.array(guess.distortion_coefficients, dtype=np.float64)
+            criteria = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, max_iterations or 100, np.finfo(np.float64).eps)
+            object_points = [p.astype(np.float64) for p in object_points]
+            image_points = [p.astype(np.float64) for p in image_points]
+            rms, camera_matrix, dist_coeffs, rvecs, tvecs = cv2.fisheye.calibrate(
+                object_points, image_points, self.image_size, camera_matrix, dist_coeffs, flags=flags, criteria=criteria)
+            if per_view_errors:
+                # cv2.fisheye has no calibrateCameraExtended, so reproject each view with its estimated pose
+                errors = np.empty(len(image_points))
+                for i, (object_view, image_view) in enumerate(zip(object_points, image_points)):
+                    projected, _ = cv2.fisheye.projectPoints(object_view, rvecs[i], tvecs[i], camera_matrix, dist_coeffs)
+                    errors[i] = math.sqrt(np.mean(np.sum((projected.reshape(-1, 2) - image_view.reshape(-1, 2)) ** 2, axis=1)))
+        else:
+            flags = 0
+            camera_matrix, dist_coeffs = None, None
+            if guess is not None:
+                flags |= cv2.CALIB_USE_INTRINSIC_GUESS
+                camera_matrix, dist_coeffs = guess.camera_matrix, np.array(guess.distortion_coefficients, dtype=np.float64)
+            criteria = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, max_iterations or 30, np.finfo(np.float64).eps)
+            if per_view_errors:
+                rms, camera_matrix, dist_coeffs, _, _, _, _, errors = cv2.calibrateCameraExtended(
+                    object_points, image_points, self.image_size, camera_matrix, dist_coeffs, flags=flags, criteria=criteria)
+                errors = errors.ravel()
+            else:
+                rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(
+                    object_points, image_points, self.image_size, camera_matrix, dist_coeffs, flags=flags, criteria=criteria)
+        intrinsics = IntrinsicParameters(self.camera_model, camera_matrix[0, 0], camera_matrix[1, 1],
+                                         camera_matrix[0, 2], camera_matrix[1, 2], dist_coeffs.ravel().tolist(), rms=rms)
+        if per_view_errors:
+            return intrinsics, errors
+        return intrinsics
+
+    def _solve_robust(self, object_points, image_points, guess=None, job=None):
+        """
+        Solves, then repeatedly drops the views whose error is more than outlier_mad_k (scaled) MADs above the
+        median of the kept views and re-solves (warm-started) without them, until no more views are dropped.
+        Returns the IntrinsicParameters, with dropped_views (indices into the given views) and n_rounds set.
+        """
+        kept = np.arange(len(image_points))
+        dropped = []
+        intrinsics = guess
+        for n_rounds in range(1, self.max_robust_rounds + 1):
+            if job is not None:
+                job.report(f"robust round {n_rounds}: {len(kept)} samples", (n_rounds - 1) / self.max_robust_rounds)
+            intrinsics, errors = self._solve_step([object_points[i] for i in kept], [image_points[i] for i in kept],
+                                                  intrinsics, per_view_errors=True)
+            if n_rounds == self.max_robust_rounds:
+                break # the last solve must include exactly the views that are kept
+            median = np.median(errors)
+            mad = 1.4826 * np.median(np.abs(errors - median)) # scaled to the standard deviation of normal errors
+            # With (nearly) identical errors the MAD is ~0, which would make every view above the median an outlier
+            mad = max(mad, self.min_outlier_mad_fraction * median)
+            outliers = errors > median + self.outlier_mad_k * mad
+            if not np.any(outliers) or len(kept) - np.count_nonzero(outliers) < self.min_robust_views:
+                break
+            dropped.extend(int(i) for i in kept[outliers])
+            kept = kept[~outliers]
+        intrinsics.dropped_views = sorted(dropped)
+        intrinsics.n_rounds = n_rounds
+        return intrinsics
+
+    def _schedule_background_solve(self):
+        object_points, image_points = self._calibration_points()
+        # The store's rows shift when samples are removed, so the background solve gets a copy of the image points
+        image_points = [points.copy() for points in image_points]
+        with self._solve_lock:
+            self._pending_solve = (object_points, image_points, self._generation)
+            if self._solving:
+                return
+            self._solving = True
+        if self._solve_executor is None:
+            self._solve_executor = ThreadPoolExecutor(max_workers=1)
+        self._solve_executor.submit(self._background_solve)
+
+    def _background_solve(self):
+        while True:
+            with self._solve_lock:
+                if self._pending_solve is None:
+                    self._solving = False
+                    return
+                object_points, image_points, generation = self._pending_solve
+                self._pending_solve = None
+            try:
+                intrinsics = self._solve(object_points, image_points, self.intrinsics)
+            except cv2.error as e:
+                print(f"Background calibration failed: {e}")
+                continue
+            with self._solve_lock:
+                if generation != self._generation:
+                    continue # a foreground calibration started since, and its result takes precedence
+                self.intrinsics = intrinsics
+                self.intrinsics_n_samples = len(image_points)
+                self.n_background_solves += 1
+
+    def close(self):
+        super().close()
+        if self._calibration_executor is not None:
+            self._calibration_executor.shutdown(wait=False)
+            self._calibration_executor = None
+        if self._solve_executor is not None:
+            self._solve_executor.shutdown(wait=False)
+            self._solve_executor = None
+
+    def save(self, file_path=None):
+        self.save_raw_data(file_path)
+
+    def save_raw_data(self, file_path=None):
+        """
+        Saves the images of the samples along with the detected points (points.npz) to a folder.
+        Images that were already compressed in the background are written as-is.
+        """
+        if file_path is None:
+            file_path = self.output_path
+        os.makedirs(file_path, exist_ok=True)
+        for i, sample in enumerate(self.samples):
+            image_path = os.path.join(file_path, f"sample_{i:04d}.png")
+            raw_image = sample.raw_image()
+            if isinstance(raw_image, CompressedImage):
+                with open(image_path, "wb") as f:
+                    f.write(raw_image.data)
+            elif raw_image is not None:
+                cv2.imwrite(image_path, sample.image)
+        np.savez(os.path.join(file_path, "points.npz"),
+                 points=self.samples.points, n_visible=self.samples.n_visible, timestamps=self.samples.timestamps,
+                 params=self.samples.params, image_size=np.array(self.image_size if self.image_size is not None else (0, 0)))
+        print(f"Saved {len(self.samples)} samples to {file_path}")
+
+    def load_raw_data(self, file_path=None):
+        """
+        Loads the samples saved by save_raw_data. Only the points are read: the images are FileImages,
+        which are decoded if (and when) something reads them, so re-solving a saved dataset is fast.
+        """
+        if file_path is None:
+            file_path = self.output_path
+        data = np.load(os.path.join(file_path, "points.npz"))
+        n_samples = len(data["points"])
+        params = data["params"] if "params" in data else np.full((n_samples, 4), np.nan, dtype=np.float32)
+        image_size = tuple(int(x) for x in data["image_size"]) if "image_size" in data else (0, 0)
+        image_size = None if image_size == (0, 0) else image_size
+        file_names = set(os.listdir(file_path))
+        for i in range(n_samples):
+            image_name = f"sample_{i:04d}.png"
+            image = FileImage(os.path.join(file_path, image_name)) if image_name in file_names else None
+            pixel_points = data["points"][i, :data["n_visible"][i]].reshape(-1, 1, 2)
+            sample = MonoSample(image, pixel_points, self.pattern)
+            self._restore_sample(sample, None if np.isnan(params[i]).any() else params[i], image_size)
+        print(f"Loaded {n_samples} samples from {file_path}")
+
+    def remove_most_recent_sample(self):
+        if len(self.samples) == 0:
+            print("There are no samples to remove")
+            return
+        self.remove_sample(len(self.samples) - 1)
+
     def distribution_is_good(self):
         if self.n_points < self.min_n_points:
             return False
         
-        if np.any(self.xy_bin_count < self.min_n_points_per_bin):
+        if not self.coverage.is_covered:
             return False
         
         # check that the samples are spread out enough
         if(self.min_scale_range_px is not None and 
-           self.xy_bin_count[0,2] < self.min_scale_range_px):
+           self.coverage.size_range_px < self.min_scale_range_px):
             return False
         
         if(self.min_skew_range_deg is not None and 
-           self.xy_bin_count[1,2] < self.min_skew_range_deg):
+           self.coverage.skew_range_deg < self.min_skew_range_deg):
             return False
         
         return True
     
-    def calibrate(self, force=False):
+    def calibrate(self, force=False, job=None):
         """
         Runs the calibration
         """
+        calibrate = self.prepare_calibration(force)
+        if calibrate is None:
+            return None
+        return calibrate(job)
+
+    def prepare_calibration(self, force=False):
         if force:
             print("Warning: the distribution of samples is not good enough to guarantee good calibration results")
         elif not self.distribution_is_good():
             print("The distribution of samples is not good, skipping calibration")
-            return
-        
+            return None
+
+        indices = None
+        if self.max_views is not None and len(self.samples) > self.max_views:
+            indices = self.select_views(self.max_views)
+        n_samples = len(self.samples)
+        object_points, image_points = self._calibration_points(indices)
+        # The store's rows shift when samples are removed, so the calibration gets a copy of the image points
+        image_points = [points.copy() for points in image_points]
+        with self._solve_lock:
+            self._generation += 1
+        return lambda job: self._calibrate(object_points, image_points, indices, n_samples, job)
+
+    def _calibrate(self, object_points, image_points, indices, n_samples, job=None):
+        """
+        Runs the calibration on a snapshot of the samples taken by prepare_calibration.
+        """
         print("Calibrating...")
-        # Extract object points and image points from samples
-        object_points = []  # 3D points in real world space
-        image_points = []   # 2D points in image plane
-        
-        for sample in self.samples:
-            # Convert world_points to numpy array for object points
-            obj_pts = np.array([point.coordinates for point in sample.world_points], dtype=np.float32)
-            object_points.append(obj_pts)
-            
-            # Convert pixel_points to numpy array for image points
-            img_pts = np.array([point.coordinates for point in sample.pixel_points], dtype=np.float32)
-            image_points.append(img_pts)
-        
-        # Initialize camera matrix if not already set
-        if self.camera.camera_matrix is None:
-            self.camera.camera_matrix = np.zeros((3, 3), dtype=np.float32)
-            self.camera.camera_matrix[0, 0] = 1.0  # Initial guess for fx
-            self.camera.camera_matrix[1, 1] = 1.0  # Initial guess for fy
-            self.camera.camera_matrix[0, 2] = self.camera.image_width / 2   # Initial guess for cx
-            self.camera.camera_matrix[1, 2] = self.camera.image_height / 2  # Initial guess for cy
-            self.camera.camera_matrix[2, 2] = 1.0
-        
-        # Initialize distortion coefficients if not already set
-        if self.camera.dist_coeffs is None:
-            self.camera.dist_coeffs = np.zeros(5, dtype=np.float32)
-        
-        # Run calibration and get results
-        ret, camera_matrix, dist_coeffs, rvecs, tvecs = cv2.calibrateCamera(
-            objectPoints=object_points,
-            imagePoints=image_points,
-            imageSize=(self.camera.image_width, self.camera.image_height),
-            cameraMatrix=self.camera.camera_matrix,
-            distCoeffs=self.camera.dist_coeffs,
-        )
+        if indices is not None:
+            print(f"Solving on {len(indices)} of {n_samples} samples, selected for coverage")
+        # Start from the latest solution (eg. from background calibration), which is usually close already,
+        # so that only a few iterations are needed
+        if self.robust:
+            intrinsics = self._solve_robust(object_points, image_points, self.intrinsics, job)
+            if indices is not None:
+                intrinsics.dropped_views = [indices[i] for i in intrinsics.dropped_views]
+        else:
+            intrinsics = self._solve(object_points, image_points, self.intrinsics, job)
+        if job is not None:
+            job.report("done", 1.0) # a job cancelled during the last step doesn't change the calibrator
+        self.intrinsics = intrinsics
+        self.intrinsics_n_samples = len(image_points) - len(intrinsics.dropped_views or [])
+        self.print_calibration_results()
+        return self.intrinsics
 
-        return IntrinsicParameters(
-            camera_matrix=camera_matrix,
-            dist_coeffs=dist_coeffs,
-            rvecs=rvecs,
-            tvecs=tvecs,
-        )
-        
+    def print_calibration_results(self):
+        if self.intrinsics is None:
+            print("Not calibrated yet")
+            return
+        print(f"RMS reprojection error: {self.intrinsics.rms:.4f} px ({self.intrinsics_n_samples} samples)")
+        if self.intrinsics.dropped_views:
+            print(f"Dropped {len(self.intrinsics.dropped_views)} outlier samples in {self.intrinsics.n_rounds} rounds: "
+                  f"{self.intrinsics.dropped_views}")
+        print(self.intrinsics)
 
 class StereoCalibrator(Calibrator):
-    def __init__(self, l_camera_model: CameraModel, r_camera_model: CameraModel = None):
-        super().__init__(l_camera_model)
+    def __init__(self, l_camera_model: CameraModel, r_camera_model: CameraModel = None, pattern=None):
+        super().__init__(l_camera_model, pattern)
         if r_camera_model is None:
             r_camera_model = l_camera_model
         self.right_camera_model = r_camera_model
-        self.left_calibrator = IntrinsicCalibrator(l_camera_model)
-        self.right_calibrator = IntrinsicCalibrator(r_camera_model)
+        self.left_calibrator = IntrinsicCalibrator(l_camera_model, pattern)
+        self.right_calibrator = IntrinsicCalibrator(r_camera_model, pattern)
+        # The points of each view are stored by the left and right calibrators, so only the pairs are kept here
+        self.samples = []
+
+    @staticmethod
+    def _mono_sample(image, pixel_points, sample, pyramid):
+        # Share the stereo sample's pyramid so that the image is only converted once
+        mono_sample = MonoSample(image, pixel_points, sample.pattern, sample.point_ids)
+        mono_sample._pyramid = (image, pyramid)
+        return mono_sample
     
     def maybe_add_sample(self, sample: StereoSample):
         """
@@ -193,22 +786,36 @@ class StereoCalibrator(Calibrator):
         # If only one image is present (because the sample is out of view of one camera),
         # then only add the sample to the calibrator that has the image.
         if sample.left_image is None:
-            mono_sample = MonoSample(sample.world_points, sample.right_image)
+            mono_sample = self._mono_sample(sample.right_image, sample.right_pixel_points, sample, sample.right_pyramid)
             self.right_calibrator.maybe_add_sample(mono_sample)
         elif sample.right_image is None:
-            mono_sample = MonoSample(sample.world_points, sample.left_image)
+            mono_sample = self._mono_sample(sample.left_image, sample.left_pixel_points, sample, sample.left_pyramid)
             self.left_calibrator.maybe_add_sample(mono_sample)
         else:
-            mono_sample_left = MonoSample(sample.world_points, sample.left_image)
-            mono_sample_right = MonoSample(sample.world_points, sample.right_image)
+            mono_sample_left = self._mono_sample(sample.left_image, sample.left_pixel_points, sample, sample.left_pyramid)
+            mono_sample_right = self._mono_sample(sample.right_image, sample.right_pixel_points, sample, sample.right_pyramid)
             self.left_calibrator.maybe_add_sample(mono_sample_left)
             self.right_calibrator.maybe_add_sample(mono_sample_right)
+            # Keep the images the mono calibrators kept, so that ingested frames are only copied once
+            sample.left_image = own(mono_sample_left.raw_image())
+            sample.right_image = own(mono_sample_right.raw_image())
             self.samples.append(sample)
 
+    def ingest(self, left_buffer, right_buffer, shape=None, strides=None, dtype=None, offset=0):
+        """
+        Processes a stereo pair given as two buffers with the same layout (see Calibrator.ingest).
+        Either buffer may be None if the pattern is out of view of that camera.
+        """
+        left = None if left_buffer is None else wrap_buffer(left_buffer, shape, strides, dtype, offset)
+        right = None if right_buffer is None else wrap_buffer(right_buffer, shape, strides, dtype, offset)
+        self.maybe_add_sample(StereoSample(left, right))
+        self.left_calibrator._release_borrowed_sample()
+        self.right_calibrator._release_borrowed_sample()
+
     def distribution_is_good(self):
         return self.left_calibrator.distribution_is_good() and self.right_calibrator.distribution_is_good()
     
-    def calibrate(self, force=False):
+    def calibrate(self, force=False, job=None):
         """
         Runs the calibration
         """
@@ -220,8 +827,10 @@ class StereoCalibrator(Calibrator):
         
         print("Calibrating...")
         # First perform an intrinsic calibration for each camera
-        K_left, dist_coeffs_left = self.left_calibrator.calibrate()
-        K_right, dist_coeffs_right = self.right_calibrator.calibrate()
+        K_left, dist_coeffs_left = self.left_calibrator.calibrate(force, job)
+        K_right, dist_coeffs_right = self.right_calibrator.calibrate(force, job)
+        if job is not None:
+            job.report("stereo calibration", 0.9)
 
         # Then perform a stereo calibration
         ret, K_left, K_right, R, t, E, F = cv2.stereoCalibrate(
@@ -251,7 +860,7 @@ class HandEyeCalibrator(Calibrator):
     def distribution_is_good(self):
         return self.intrinsic_calibrator.distribution_is_good()
     
-    def calibrate(self, force=False):
+    def calibrate(self, force=False, job=None):
         """
         Runs the calibration
         """
@@ -2,17 +2,64 @@ from abc import ABC, abstractmethod
 import cv2
 import numpy as np
 from camera_calibration.calibrator import Calibrator, IntrinsicCalibrator, StereoCalibrator
+from camera_calibration.calibration_job import CalibrationCancelled
 
 class CalibratorGUI(ABC):
     def __init__(self, calibrator: Calibrator, window_name: str):
         self.calibrator = calibrator
         self.window_name = window_name
+        self.max_display_area = 640 * 480 # frames are shown at (approximately) this size
+        self.job = None # the running CalibrationJob, if any
 
     @abstractmethod
     def show(self, sample):
         pass
 
+    def start_calibration(self, force=False):
+        """
+        Starts calibrating in the background, so that frames keep being shown while it runs.
+        """
+        if self.job is not None:
+            print("Calibration is already running, press [x] to cancel it")
+            return
+        self.job = self.calibrator.calibrate_async(force) # None if the calibration was skipped
+
+    def cancel_calibration(self):
+        if self.job is not None:
+            self.job.cancel()
+
+    def poll_calibration(self):
+        """
+        Reports the outcome of the calibration job once it has finished.
+        """
+        if self.job is None or not self.job.done():
+            return
+        job, self.job = self.job, None
+        if job.future.cancelled():
+            print("Calibration cancelled")
+            return
+        error = job.future.exception()
+        if isinstance(error, CalibrationCancelled):
+            print(f"Calibration cancelled after {job.elapsed:.1f}s")
+        elif error is not None:
+            print(f"Calibration failed: {error}")
+        else:
+            print(f"Calibration finished in {job.elapsed:.1f}s")
+
+    def draw_status(self, display):
+        """
+        Draws the progress of the running calibration (if any) onto the display image, and returns it.
+        """
+        if self.job is None:
+            return display
+        display = display.copy() # don't draw on the shared image
+        text = f"Calibrating: {self.job.stage} {100 * self.job.progress:.0f}% {self.job.elapsed:.1f}s [x] cancel"
+        color = 255 if display.ndim == 2 else (0, 255, 255)
+        cv2.putText(display, text, (10, display.shape[0] - 15), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+        return display
+
     def handle_keypress(self):
+        self.poll_calibration()
         key = cv2.waitKey(1) & 0xFF
         if key == ord('q') or key == 27:
             cv2.destroyAllWindows()
@@ -20,9 +67,11 @@ class CalibratorGUI(ABC):
         elif key == ord('a'):
             self.calibrator.toggle_auto_collect()
         elif key == ord('c'):
-            self.calibrator.calibrate()
+            self.start_calibration()
         elif key == ord('f'):
-            self.calibrator.calibrate(force=True)
+            self.start_calibration(force=True)
+        elif key == ord('x'):
+            self.cancel_calibration()
         elif key == ord('s'):
             self.calibrator.save()
         elif key == ord('r'):
@@ -42,20 +91,28 @@ class CalibratorGUI(ABC):
               [f] force calibration and save the data and results
               [q] or [esc] save data then quit
               [r] remove most recent sample
+              [x] cancel the running calibration
               [s] save raw data (and results if available)
               [spacebar] collect sample (if auto-collect is off)
               """
         )
 
-class IntrinsicCalibratorGUI:
+class IntrinsicCalibratorGUI(CalibratorGUI):
     def __init__(self, calibrator: IntrinsicCalibrator, window_name: str):
         super().__init__(calibrator, window_name)
     
     def show(self, sample):
         self.handle_keypress()
-        cv2.imshow(self.window_name, sample.image)
+        # The downsampled image is shared with detection, so this doesn't resize the frame again
+        display, _ = sample.pyramid.downsample(self.max_display_area)
+        intrinsics = self.calibrator.intrinsics
+        if intrinsics is not None:
+            display = display.copy() # don't draw on the shared image
+            text = f"RMS {intrinsics.rms:.3f} px ({self.calibrator.intrinsics_n_samples} samples)"
+            cv2.putText(display, text, (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 255 if display.ndim == 2 else (0, 255, 0), 2)
+        cv2.imshow(self.window_name, self.draw_status(display))
 
-class StereoCalibratorGUI:
+class StereoCalibratorGUI(CalibratorGUI):
     def __init__(self, calibrator: StereoCalibrator, window_name: str):
         super().__init__(calibrator, window_name)
 
@@ -65,30 +122,34 @@ class StereoCalibratorGUI:
         if sample.left_image is None and sample.right_image is None:
             print("Warning: Missing left and right image in stereo sample")
             return
-        elif sample.left_image is None:
+
+        # Use the downsampled images shared with detection, so that only the small display images are converted
+        left_img_display = None
+        right_img_display = None
+        if sample.left_image is not None:
+            left_img_display, _ = sample.left_pyramid.downsample(self.max_display_area)
+        if sample.right_image is not None:
+            right_img_display, _ = sample.right_pyramid.downsample(self.max_display_area)
+
+        if left_img_display is None:
             print("Warning: Missing left image in stereo sample")
-            left_img_display = np.zeros(sample.right_image.shape, dtype=np.uint8)
-        elif sample.right_image is None:
+            left_img_display = np.zeros(right_img_display.shape, dtype=np.uint8)
+        elif right_img_display is None:
             print("Warning: Missing right image in stereo sample")
-            right_img_display = np.zeros(sample.left_image.shape, dtype=np.uint8)
+            right_img_display = np.zeros(left_img_display.shape, dtype=np.uint8)
         else:
             # both images are not None, but may differ in shape.
             # first handle difference in depth (rgb vs grayscale)
-            left_dims = sample.left_image.ndim
-            right_dims = sample.right_image.ndim
-            if left_dims == 2 and right_dims == 2:
-                left_img_display = sample.left_image
-                right_img_display = sample.right_image
-            elif left_dims == 3 and right_dims == 2:
-                left_img_display = sample.left_image
-                right_img_display = cv2.cvtColor(sample.right_image, cv2.COLOR_GRAY2BGR)
+            left_dims = left_img_display.ndim
+            right_dims = right_img_display.ndim
+            if left_dims == 3 and right_dims == 2:
+                right_img_display = cv2.cvtColor(right_img_display, cv2.COLOR_GRAY2BGR)
             elif left_dims == 2 and right_dims == 3:
-                left_img_display = cv2.cvtColor(sample.left_image, cv2.COLOR_GRAY2BGR)
-                right_img_display = sample.right_image
-            else:
-                raise ValueError(f"Left image dimensions: {left_dims} 
-                                 and right image dimensions: {right_dims} 
-                                 need to be greyscale (2) or rgb (3)")
+                left_img_display = cv2.cvtColor(left_img_display, cv2.COLOR_GRAY2BGR)
+            elif left_dims != right_dims:
+                raise ValueError(f"Left image dimensions: {left_dims} "
+                                 f"and right image dimensions: {right_dims} "
+                                 "need to be greyscale (2) or rgb (3)")
             
         # now handle difference in shape
         def pad_to_height(img, target_height):
@@ -103,4 +164,4 @@ class StereoCalibratorGUI:
 
         combined_img = np.concatenate((left_img_display, right_img_display), axis=1)
 
-        cv2.imshow(self.window_name, combined_img)
+        cv2.imshow(self.window_name, self.draw_status(combined_img))
@@ -1,6 +1,7 @@
 from camera_calibration.calibrator import Calibrator, IntrinsicCalibrator, StereoCalibrator, HandEyeCalibrator
 from camera_calibration.enums import CalibrationMode, PatternType, CameraModel
-from camera_calibration.pattern import Chessboard, AcirclesGrid
+from camera_calibration.pattern import RadonCheckerboard, Chessboard, AcirclesGrid
+from camera_calibration.session_journal import SessionJournal
 import argparse
 class PatternAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_strings=None):
@@ -32,7 +33,13 @@ class PatternAction(argparse.Action):
             parser.error(f"Pattern {values} requires a positive square size")
             
         # Create and store the pattern based on type
-        if values == PatternType.CHESSBOARD.value:
+        if values == PatternType.RADON_CHECKERBOARD.value:
+            pattern = RadonCheckerboard(
+                n_rows=namespace.current_rows,
+                n_cols=namespace.current_columns,
+                square_size=namespace.current_square_size
+            )
+        elif values == PatternType.CHESSBOARD.value:
             pattern = Chessboard(
                 n_rows=namespace.current_rows,
                 n_cols=namespace.current_columns,
@@ -88,6 +95,14 @@ def parse_arguments():
                         help='Fix the principal point at the center')
     parser.add_argument('--fix-aspect-ratio', action='store_true',
                         help='Fix the aspect ratio')
+    parser.add_argument('--background-calibration', action='store_true',
+                        help='Re-calibrate in the background whenever a sample is accepted (intrinsic calibration only)')
+
+    # Session journal
+    parser.add_argument('--session', type=str, default=None,
+                        help='Folder to journal the accepted samples to as they arrive, so that the session can be resumed after a crash')
+    parser.add_argument('--resume', type=str, default=None, metavar='SESSION',
+                        help='Resume the session journaled in this folder (new samples are journaled there too)')
     
     args = parser.parse_args()
     
@@ -111,17 +126,33 @@ def parse_arguments():
         # TODO: if the pattern has rotational symmetry, then we'll have problems
         pass
 
-    # Final validation to ensure the last pattern is complete
-    if hasattr(args, 'current_rows') or hasattr(args, 'current_columns') or hasattr(args, 'current_square_size'):
-        parser.error("Incomplete pattern parameters. Each --pattern must be followed by --rows, --columns, and --square-size-mm")
+    if args.calibration_mode == CalibrationMode.STEREO.value and (args.session is not None or args.resume is not None):
+        # The stereo calibrator keeps its pairs itself rather than adding them as samples, so nothing would be journaled
+        parser.error("--session and --resume are not supported for stereo calibration")
+
+    # Final validation to ensure no pattern parameters were left over after the last pattern
+    # (argparse always sets the attributes, so check their values)
+    if args.current_rows is not None or args.current_columns is not None or args.current_square_size is not None:
+        parser.error("Incomplete pattern parameters. Each --pattern must be preceded by --rows, --columns, and --square-size-mm")
     
     return args
 
 def create_calibrator(args) -> Calibrator:
+    # The samples are calibrated (and resumed from a session) with the first pattern's object points
+    patterns = getattr(args, 'patterns', [])
+    pattern = patterns[0] if patterns else None
     if args.calibration_mode == CalibrationMode.INTRINSIC.value:
-        calibrator = IntrinsicCalibrator(args.camera_model)
+        calibrator = IntrinsicCalibrator(args.camera_model, pattern)
+        calibrator.background_calibration = args.background_calibration
     elif args.calibration_mode == CalibrationMode.STEREO.value:
-        calibrator = StereoCalibrator(args.camera_model, args.right_camera_model)
+        calibrator = StereoCalibrator(args.camera_model, args.right_camera_model, pattern)
     elif args.calibration_mode == CalibrationMode.HAND_EYE.value:
         calibrator = HandEyeCalibrator(args.camera_model)
-    return calibrator
\ No newline at end of file
+
+    session = args.resume if args.resume is not None else args.session
+    if session is not None:
+        journal = SessionJournal(session)
+        if args.resume is not None:
+            calibrator.resume(journal)
+        calibrator.journal = journal
+    return calibrator
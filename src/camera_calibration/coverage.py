@@ -0,0 +1,98 @@
+"""
+Whether the samples cover the image well enough to calibrate is checked on every frame, so the coverage
+statistics are kept up to date as samples are added and removed, rather than recomputed from all the samples.
+"""
+import bisect
+import math
+import numpy as np
+
+class CoverageAccumulator:
+    """
+    Incrementally maintained coverage statistics of the samples:
+    - a 2D histogram of the corner positions, with bins of about bin_size_px (clipped to
+      min_bins..max_bins per axis), so that higher resolution images are divided into more regions
+    - the range of the sizes (in pixels) and the skews (in degrees) of the views
+    Adding or removing a sample costs O(K) for K points; the checks are independent of the number of samples.
+    """
+    def __init__(self, bin_size_px=160, min_bins=2, max_bins=8, min_points_per_bin=3):
+        self.bin_size_px = bin_size_px
+        self.min_bins = min_bins
+        self.max_bins = max_bins
+        self.min_points_per_bin = min_points_per_bin # a bin with fewer points is sparse
+        self.image_size = None # (width, height); the histogram is created once this is known
+        self.histogram = None # (n_y_bins, n_x_bins) point counts
+        self.n_sparse_bins = None
+        self._sizes = [] # sorted sizes of the views in pixels
+        self._skews = [] # sorted skews of the views in degrees
+
+    def set_image_size(self, image_size):
+        """
+        Sets the image size and (re)creates an empty histogram for it.
+        """
+        width, height = image_size
+        self.image_size = (width, height)
+        n_x = int(np.clip(round(width / self.bin_size_px), self.min_bins, self.max_bins))
+        n_y = int(np.clip(round(height / self.bin_size_px), self.min_bins, self.max_bins))
+        self.histogram = np.zeros((n_y, n_x), dtype=np.int64)
+        self.n_sparse_bins = self.histogram.size if self.min_points_per_bin > 0 else 0
+
+    def _bin_counts(self, points):
+        width, height = self.image_size
+        n_y, n_x = self.histogram.shape
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        x = np.clip((points[:, 0] * (n_x / width)).astype(np.int64), 0, n_x - 1)
+        y = np.clip((points[:, 1] * (n_y / height)).astype(np.int64), 0, n_y - 1)
+        return np.bincount(y * n_x + x, minlength=self.histogram.size).reshape(n_y, n_x)
+
+    def _view_size_and_skew(self, params):
+        """
+        Converts the view parameters [X, Y, size, skew] (see calibrator.get_parameters) to pixels and degrees.
+        """
+        width, height = self.image_size
+        params = np.asarray(params, dtype=np.float32) # as stored by the SampleStore, so that removals match additions
+        size_px = float(params[2]) * math.sqrt(width * height)
+        skew_deg = math.degrees(float(params[3]) / 2.)
+        return size_px, skew_deg
+
+    def add(self, points, params=None):
+        """
+        Adds the points of a sample, and its view parameters if known.
+        """
+        self.histogram += self._bin_counts(points)
+        self.n_sparse_bins = int(np.count_nonzero(self.histogram < self.min_points_per_bin))
+        if params is not None:
+            size_px, skew_deg = self._view_size_and_skew(params)
+            bisect.insort(self._sizes, size_px)
+            bisect.insort(self._skews, skew_deg)
+
+    def remove(self, points, params=None):
+        """
+        Removes a sample that was added with the same points and parameters.
+        """
+        self.histogram -= self._bin_counts(points)
+        self.n_sparse_bins = int(np.count_nonzero(self.histogram < self.min_points_per_bin))
+        if params is not None:
+            size_px, skew_deg = self._view_size_and_skew(params)
+            del self._sizes[bisect.bisect_left(self._sizes, size_px)]
+            del self._skews[bisect.bisect_left(self._skews, skew_deg)]
+
+    def clear(self):
+        if self.image_size is not None:
+            self.set_image_size(self.image_size)
+        self._sizes.clear()
+        self._skews.clear()
+
+    @property
+    def size_range_px(self):
+        return self._sizes[-1] - self._sizes[0] if self._sizes else 0.0
+
+    @property
+    def skew_range_deg(self):
+        return self._skews[-1] - self._skews[0] if self._skews else 0.0
+
+    @property
+    def is_covered(self):
+        """
+        True if every bin of the histogram has at least min_points_per_bin points.
+        """
+        return self.n_sparse_bins == 0
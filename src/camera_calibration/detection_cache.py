@@ -0,0 +1,144 @@
+"""
+Re-running a calibration on the same dataset (eg. with different solver flags) shouldn't
+pay for corner detection again. The detection cache stores the detected corners on disk,
+keyed by a hash of the image bytes and the pattern/detector settings.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+
+class DetectionCache:
+    """
+    A content-addressed, size-limited cache of detected corners in a directory.
+    Each entry is a small .npy file holding the (n_points, 2) float32 corners (or an empty array
+    if the pattern was not found in the image). When the cache grows past max_bytes,
+    the least recently used entries are evicted.
+    The directory can be shared by several processes (eg. the batch detection workers): entries written by
+    the others are picked up on a miss, and the size limit is checked against the whole directory
+    (which is rescanned when this process goes over the limit, and after every rescan_every entries it writes).
+    """
+    # How many entries this process writes between rescans of the directory (to count the entries of the others)
+    rescan_every = 64
+
+    def __init__(self, directory, max_bytes=256 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.n_hits = 0
+        self.n_misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def __getstate__(self):
+        # The index is rebuilt from the directory when unpickled (eg. in a worker process),
+        # since the parent's copy may be out of date
+        state = self.__dict__.copy()
+        del state['_index'], state['_total_bytes'], state['_n_puts']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._scan()
+
+    def _scan(self):
+        """
+        Rebuilds the index from the directory, with the LRU order from the modification times (which are bumped on every hit).
+        """
+        self._index = OrderedDict() # key -> size in bytes, least recently used first
+        self._total_bytes = 0
+        self._n_puts = 0 # entries written since the last scan
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue # evicted by another process
+                entries.append((stat.st_mtime, entry.name[:-len(".npy")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def key(data, pattern):
+        """
+        Returns the cache key for an image (or the encoded bytes of an image file) and a pattern.
+        The key covers the pattern geometry and detector settings, so changing them invalidates the entries.
+        """
+        data = np.ascontiguousarray(data)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((type(pattern).__name__, pattern.n_rows, pattern.n_cols, pattern.downsample,
+                       pattern.max_detection_area, pattern.max_refine_radius, data.shape, data.dtype.str)).encode())
+        h.update(data.data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        """
+        Returns (hit, corners). corners is None on a miss, and also on a hit for an image without the pattern.
+        """
+        # Entries that aren't in the index may have been written by another process sharing the directory
+        path = self._path(key)
+        try:
+            corners = np.load(path)
+            os.utime(path)
+            size = os.path.getsize(path)
+        except (FileNotFoundError, ValueError):
+            # evicted by another process sharing the directory, or a partially written file
+            self._forget(key)
+            self.n_misses += 1
+            return False, None
+        if key in self._index:
+            self._index.move_to_end(key)
+        else:
+            self._index[key] = size
+            self._total_bytes += size
+        self.n_hits += 1
+        if len(corners) == 0:
+            return True, None
+        return True, corners.reshape(-1, 1, 2)
+
+    def put(self, key, corners):
+        if corners is None:
+            corners = np.empty((0, 2), dtype=np.float32)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(corners, dtype=np.float32).reshape(-1, 2))
+        os.replace(tmp_path, path) # atomic, so readers never see a partial entry
+
+        self._forget(key)
+        size = os.path.getsize(path)
+        self._index[key] = size
+        self._total_bytes += size
+        self._n_puts += 1
+        self._evict()
+
+    def _forget(self, key):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def _evict(self):
+        if self._total_bytes > self.max_bytes or self._n_puts >= self.rescan_every:
+            # Count the entries written by the other processes sharing the directory too
+            self._scan()
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        self._scan() # including the entries written by other processes
+        for key in list(self._index):
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+        self._index.clear()
+        self._total_bytes = 0
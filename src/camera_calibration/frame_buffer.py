@@ -0,0 +1,46 @@
+"""
+Frames from a capture stack often arrive as raw bytes in a buffer that the driver owns and will reuse
+(eg. a slot of a ring buffer). wrap_buffer makes an ndarray view of such a buffer without copying it,
+so that the frame can be detected in place; the frame is only copied (see own) if it is kept as a sample.
+"""
+import numpy as np
+
+class BorrowedFrame(np.ndarray):
+    """
+    A read-only view of a buffer that the calibrator doesn't own, so it must be copied before it is kept.
+    """
+    pass
+
+def wrap_buffer(buffer, shape=None, strides=None, dtype=None, offset=0):
+    """
+    Returns a BorrowedFrame viewing buffer, which may be any object supporting the buffer protocol.
+    The layout is taken from the buffer's own shape, strides and format (eg. a memoryview or an array),
+    unless shape (and optionally strides in bytes, eg. for padded rows, and dtype) are given,
+    in which case the buffer is treated as raw bytes starting at offset.
+    """
+    view = memoryview(buffer)
+    if shape is None:
+        frame = np.asarray(view)
+        if dtype is not None:
+            frame = frame.view(dtype)
+    else:
+        dtype = np.dtype(view.format if dtype is None else dtype)
+        flat = np.frombuffer(view.cast("B"), dtype=dtype, count=(view.nbytes - offset) // dtype.itemsize, offset=offset)
+        if strides is None:
+            strides = tuple(int(s) for s in np.cumprod((dtype.itemsize,) + tuple(shape[:0:-1]))[::-1])
+        extent = sum((n - 1) * s for n, s in zip(shape, strides)) + dtype.itemsize
+        if extent > flat.nbytes:
+            raise ValueError(f"A frame of shape {tuple(shape)} and strides {tuple(strides)} needs {extent} bytes, "
+                             f"but the buffer only has {flat.nbytes}")
+        frame = np.lib.stride_tricks.as_strided(flat, shape=tuple(shape), strides=tuple(strides))
+    frame = frame.view(BorrowedFrame)
+    frame.flags.writeable = False
+    return frame
+
+def own(image):
+    """
+    Returns the image, copied into memory of its own if it is a BorrowedFrame (or a part of one).
+    """
+    if isinstance(image, BorrowedFrame):
+        return np.array(image)
+    return image
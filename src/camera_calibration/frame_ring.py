@@ -0,0 +1,265 @@
+"""
+Capture, detection and the GUI compete for the GIL when they run in one process. The FrameRing moves capture
+into a separate process: the capture process writes each frame (or each stereo pair) into a slot of a ring
+in shared memory, and the calibrator process reads the newest slot in place, without copying it.
+Each slot carries the sequence number of its frame, so frames that the reader skipped are counted as dropped.
+
+Only the slot bookkeeping is done under a lock; frames are copied in and read outside of it. The writer never
+writes into the newest slot or the slot that the reader holds, so a frame can't change while it is being read.
+"""
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+from camera_calibration.frame_buffer import BorrowedFrame
+
+_LATEST_SLOT = 0
+_READER_SLOT = 1
+_CLOSED = 2
+_SEQUENCE = 3 # sequence number of the last frame written
+_N_FIELDS = 4
+_ALIGNMENT = 64
+
+class FrameRing:
+    """
+    A ring of n_slots frame slots in shared memory. Each slot holds one frame per stream, eg. one stream for
+    mono capture and two (left and right) for stereo capture, with the shapes given by frame_shapes.
+    Create the ring in the calibrator process and pass it to the capture process (eg. as an argument of
+    multiprocessing.Process, see CaptureProcess); it is re-attached to the same shared memory there.
+    """
+    def __init__(self, frame_shapes, dtype=np.uint8, n_slots=4):
+        if n_slots < 3:
+            raise ValueError("A frame ring needs at least 3 slots (newest, being read, being written)")
+        self.frame_shapes = [tuple(shape) for shape in frame_shapes]
+        self.dtype = np.dtype(dtype)
+        self.n_slots = n_slots
+        self._condition = multiprocessing.Condition()
+        self._owner_pid = os.getpid() # the ring is freed by the process that created it (which may be forked)
+        self._memory = shared_memory.SharedMemory(create=True, size=self._layout())
+        self._attach()
+        self._header[:] = 0
+        self._header[_LATEST_SLOT] = -1
+        self._header[_READER_SLOT] = -1
+
+        # Reader state (only meaningful in the process that reads)
+        self.last_sequence = 0
+        self.n_read = 0
+        self.n_dropped = 0
+        # Writer state (only meaningful in the process that writes)
+        self.n_written = 0
+
+    def _layout(self):
+        self._frame_bytes = [int(np.prod(shape)) * self.dtype.itemsize for shape in self.frame_shapes]
+        slot_bytes = sum(-(-n // _ALIGNMENT) * _ALIGNMENT for n in self._frame_bytes)
+        header_bytes = -(-(_N_FIELDS + self.n_slots) * 8 // _ALIGNMENT) * _ALIGNMENT
+        self._slot_bytes = slot_bytes
+        self._header_bytes = header_bytes
+        return header_bytes + self.n_slots * slot_bytes
+
+    def _attach(self):
+        buffer = self._memory.buf
+        self._header = np.ndarray((_N_FIELDS + self.n_slots,), dtype=np.int64, buffer=buffer)
+        self._slot_sequences = self._header[_N_FIELDS:]
+        self._frames = [] # [slot][stream] -> writable array
+        for slot in range(self.n_slots):
+            offset = self._header_bytes + slot * self._slot_bytes
+            frames = []
+            for shape, n_bytes in zip(self.frame_shapes, self._frame_bytes):
+                frames.append(np.ndarray(shape, dtype=self.dtype, buffer=buffer, offset=offset))
+                offset += -(-n_bytes // _ALIGNMENT) * _ALIGNMENT
+            self._frames.append(frames)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("_memory", "_header", "_slot_sequences", "_frames"):
+            del state[name]
+        state["_name"] = self._memory.name
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop("_name")
+        self.__dict__.update(state)
+        self._memory = shared_memory.SharedMemory(name=name)
+        self._layout()
+        self._attach()
+
+    @property
+    def n_streams(self):
+        return len(self.frame_shapes)
+
+    @property
+    def closed(self):
+        return bool(self._header[_CLOSED])
+
+    def write(self, *frames):
+        """
+        Copies one frame per stream into a free slot and publishes it as the newest frame.
+        Returns the frame's sequence number.
+        """
+        if len(frames) != self.n_streams:
+            raise ValueError(f"Expected {self.n_streams} frames, got {len(frames)}")
+        for frame, shape in zip(frames, self.frame_shapes):
+            if frame.shape != shape:
+                raise ValueError(f"Expected a frame of shape {shape}, got {frame.shape}")
+        with self._condition:
+            busy = (self._header[_LATEST_SLOT], self._header[_READER_SLOT])
+            slot = min((s for s in range(self.n_slots) if s not in busy), key=lambda s: self._slot_sequences[s])
+            self._slot_sequences[slot] = -1 # being written
+        for destination, frame in zip(self._frames[slot], frames):
+            np.copyto(destination, frame)
+        with self._condition:
+            self.n_written += 1
+            self._header[_SEQUENCE] += 1
+            sequence = int(self._header[_SEQUENCE])
+            self._slot_sequences[slot] = sequence
+            self._header[_LATEST_SLOT] = slot
+            self._condition.notify_all()
+        return sequence
+
+    def mark_closed(self):
+        """
+        Marks the end of the stream: readers return None once they have read the last frame,
+        and the capture process stops writing.
+        """
+        with self._condition:
+            self._header[_CLOSED] = 1
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        Marks the end of the stream and releases the shared memory. The process that created the ring also frees it.
+        """
+        if self._header is None:
+            return
+        self.mark_closed()
+        self._header = self._slot_sequences = self._frames = None
+        try:
+            self._memory.close()
+        except BufferError:
+            pass # frames that were read are still referenced; the mapping is released along with them
+        if os.getpid() == self._owner_pid:
+            self._memory.unlink()
+
+    def read(self, timeout=None):
+        """
+        Waits for a frame newer than the last one read, and returns (sequence, frames), where frames
+        is a tuple with one read-only view per stream. The views stay valid until the next read (or release),
+        after which the slot may be reused, so a frame must be copied if it is kept (see frame_buffer.own).
+        Returns None if the stream is closed or the timeout expires.
+        """
+        with self._condition:
+            self._header[_READER_SLOT] = -1
+            has_new = lambda: self._latest_sequence() > self.last_sequence or self._header[_CLOSED]
+            if not self._condition.wait_for(has_new, timeout) or self._latest_sequence() <= self.last_sequence:
+                return None
+            slot = self._header[_LATEST_SLOT]
+            self._header[_READER_SLOT] = slot
+            sequence = int(self._slot_sequences[slot])
+        self.n_dropped += sequence - self.last_sequence - 1
+        self.n_read += 1
+        self.last_sequence = sequence
+        frames = []
+        for frame in self._frames[slot]:
+            frame = frame.view(BorrowedFrame)
+            frame.flags.writeable = False
+            frames.append(frame)
+        return sequence, tuple(frames)
+
+    def release(self):
+        """
+        Releases the slot of the last frame read, so that the writer may reuse it.
+        """
+        with self._condition:
+            self._header[_READER_SLOT] = -1
+
+    def _latest_sequence(self):
+        slot = self._header[_LATEST_SLOT]
+        return 0 if slot < 0 else int(self._slot_sequences[slot])
+
+    def __iter__(self):
+        """
+        Yields the frames of each stream of the newest frame (a single frame for mono capture), until the ring is closed.
+        """
+        while True:
+            result = self.read()
+            if result is None:
+                self.release()
+                return
+            _, frames = result
+            yield frames[0] if self.n_streams == 1 else frames
+
+    def print_stats(self):
+        total = self.n_read + self.n_dropped
+        print(f"Frame ring: read {self.n_read} frames, dropped {self.n_dropped}"
+              f" ({100 * self.n_dropped / max(total, 1):.1f}%)")
+
+def _capture(ring, sources, frame_rate):
+    """
+    The capture loop run by CaptureProcess: reads from each source and writes the frames to the ring until a source ends.
+    """
+    captures = [cv2.VideoCapture(source) for source in sources]
+    period = None if frame_rate is None else 1.0 / frame_rate
+    try:
+        while not ring.closed:
+            start = time.perf_counter()
+            # Grab from all sources before decoding, so that the frames of a stereo pair are as close in time as possible
+            if not all([capture.grab() for capture in captures]):
+                break
+            frames = [capture.retrieve()[1] for capture in captures]
+            if any(frame is None for frame in frames):
+                break
+            ring.write(*frames)
+            if period is not None:
+                time.sleep(max(0.0, period - (time.perf_counter() - start)))
+    finally:
+        for capture in captures:
+            capture.release()
+        ring.close()
+
+class CaptureProcess:
+    """
+    Captures from one source (mono) or two (stereo), eg. camera indices or video files, in a separate process
+    that writes the frames into a FrameRing. The frame shapes are probed from the sources, unless they are given.
+    The ring is available as .ring; iterate over it in the calibrator process.
+    """
+    def __init__(self, sources, frame_shapes=None, n_slots=4, frame_rate=None):
+        if not isinstance(sources, (list, tuple)):
+            sources = [sources]
+        if frame_shapes is None:
+            frame_shapes = [self._probe(source) for source in sources]
+        self.sources = list(sources)
+        self.frame_rate = frame_rate # frames per second to throttle to (eg. for video files), or None
+        self.ring = FrameRing(frame_shapes, n_slots=n_slots)
+        self._process = None
+
+    @staticmethod
+    def _probe(source):
+        capture = cv2.VideoCapture(source)
+        ret, frame = capture.read()
+        capture.release()
+        if not ret:
+            raise ValueError(f"Could not read a frame from {source}")
+        return frame.shape
+
+    def start(self):
+        self._process = multiprocessing.Process(target=_capture, args=(self.ring, self.sources, self.frame_rate), daemon=True)
+        self._process.start()
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self.ring.mark_closed()
+            self._process.join(timeout=5.0)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+            self._process = None
+        self.ring.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
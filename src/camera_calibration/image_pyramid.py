@@ -0,0 +1,152 @@
+"""
+Several stages look at the same frame (pre-filters, detection, refinement, display),
+and each of them needs a grayscale and/or downsampled copy of it. The ImagePyramid
+computes those copies on first use and keeps them so that each is only computed once per frame.
+"""
+import math
+import cv2
+
+def to_gray(image):
+    """
+    Returns a single channel version of the image, converting from BGR if necessary.
+    """
+    if image.ndim == 3 and image.shape[2] == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+class ImagePyramid:
+    """
+    A frame along with its lazily computed grayscale image and downsampled levels.
+    Levels are keyed by their maximum area in pixels, eg. 640*480 for the ~VGA detection/display image.
+    """
+    def __init__(self, image):
+        self._image = image
+        self._shape = None if image is None else image.shape
+        self._load = None # loads the image again after release_image
+        self._gray = None
+        self._levels = {} # max_area -> (scrib, (x_scale, y_scale))
+        self._gray_levels = {} # max_area -> grayscale scrib
+
+    @staticmethod
+    def of(image):
+        """
+        Wraps an image in an ImagePyramid (or returns it unchanged if it already is one).
+        """
+        if isinstance(image, ImagePyramid):
+            return image
+        return ImagePyramid(image)
+
+    @staticmethod
+    def lazy(load):
+        """
+        Returns the ImagePyramid of an image that is loaded with load() (eg. decoded from a file) every time
+        the full-resolution image is used, as after release_image. Only the downsampled levels are kept.
+        """
+        pyramid = ImagePyramid(None)
+        pyramid._load = load
+        return pyramid
+
+    @property
+    def image(self):
+        if self._image is None:
+            image = self._load()
+            self._shape = image.shape
+            return image
+        return self._image
+
+    @property
+    def shape(self):
+        if self._shape is None:
+            self._shape = self.image.shape
+        return self._shape
+
+    def release_image(self, load):
+        """
+        Drops the references to the full-resolution image and its grayscale version, but keeps the downsampled
+        levels (eg. for display). If the full-resolution image is needed again, it is reloaded with load()
+        every time, and neither it nor its grayscale version is kept again.
+        """
+        full_resolution = (self._image, self._gray)
+        self._levels = {max_area: level for max_area, level in self._levels.items()
+                        if not any(level[0] is image for image in full_resolution)}
+        self._gray_levels = {max_area: gray for max_area, gray in self._gray_levels.items()
+                             if not any(gray is image for image in full_resolution)}
+        self._image = None
+        self._gray = None
+        self._load = load
+
+    def release_levels(self):
+        """
+        Drops the downsampled levels, which are computed again if they are needed.
+        """
+        self._levels = {}
+        self._gray_levels = {}
+
+    @property
+    def gray(self):
+        if self._gray is not None:
+            return self._gray
+        gray = to_gray(self.image)
+        if self._image is not None:
+            self._gray = gray # after release_image, the full-resolution images aren't kept
+        return gray
+
+    def _downsampled_size(self, max_area):
+        """
+        Returns the (width, height) of the image scaled down to approximately max_area pixels (or None if it is small enough).
+        """
+        height, width = self.shape[:2]
+        scale = math.sqrt((width * height) / max_area)
+        if scale <= 1.0:
+            return None
+        return (int(width / scale), int(height / scale))
+
+    def downsample(self, max_area):
+        """
+        Returns (scrib, (x_scale, y_scale)), where scrib is the image scaled down to approximately max_area pixels
+        (or the image itself if it is already small enough) and the scales map scrib coordinates back to the image.
+        """
+        if max_area not in self._levels:
+            image = self.image # first, so that a lazy image is only loaded once
+            size = self._downsampled_size(max_area)
+            scrib = image if size is None else cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+            self._levels[max_area] = (scrib, self.downsample_scale(max_area))
+        return self._levels[max_area]
+
+    def downsample_scale(self, max_area):
+        """
+        Returns the (x_scale, y_scale) of downsample(max_area), without scaling the image down.
+        """
+        if max_area in self._levels:
+            return self._levels[max_area][1]
+        size = self._downsampled_size(max_area)
+        if size is None:
+            return (1.0, 1.0)
+        # Due to rounding, actual horizontal/vertical scaling may differ slightly
+        height, width = self.shape[:2]
+        return (float(width) / size[0], float(height) / size[1])
+
+    def level(self, max_area):
+        """
+        Returns the scrib of downsample(max_area) if it was already computed, otherwise None.
+        """
+        level = self._levels.get(max_area)
+        return None if level is None else level[0]
+
+    def downsample_gray(self, max_area):
+        """
+        Returns the grayscale version of downsample(max_area) (with the same scales).
+        """
+        scrib, scale = self.downsample(max_area)
+        if max_area not in self._gray_levels:
+            self._gray_levels[max_area] = self.gray if scrib is self._image else to_gray(scrib)
+        return self._gray_levels[max_area], scale
+
+    def crop(self, x0, y0, x1, y1):
+        """
+        Returns the pyramid of a region of the image, reusing the grayscale image if it was already computed.
+        """
+        cropped = ImagePyramid(self.image[y0:y1, x0:x1])
+        if self._gray is not None:
+            cropped._gray = self._gray[y0:y1, x0:x1]
+        return cropped
@@ -0,0 +1,60 @@
+"""
+As a lighter alternative to keeping the raw frames of accepted samples (or spooling them to disk),
+the images can be losslessly compressed in a background thread as soon as they are accepted.
+Only the compressed bytes are kept, and the images are decoded again when they are read.
+Saving the samples then just writes the bytes that were already encoded.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from camera_calibration.sample import LazyImage
+
+class CompressedImage(LazyImage):
+    """
+    A PNG-encoded image, which may still be being encoded in the background.
+    Until the encoding is done, loading the image returns the raw image, so readers never wait for the encoder.
+    """
+    def __init__(self, future, image=None):
+        self._future = future
+        self._image = image # the raw image, released once it has been encoded
+        future.add_done_callback(self._release_image)
+
+    def _release_image(self, future):
+        self._image = None
+
+    @property
+    def data(self):
+        """
+        The encoded PNG bytes (waits for the encoding to finish).
+        """
+        return self._future.result()
+
+    def load(self):
+        image = self._image
+        if image is not None:
+            return image
+        return cv2.imdecode(np.frombuffer(self.data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+class CompressedRetention:
+    """
+    Encodes images as PNG in a background thread. A fast (low) compression level is used by default,
+    since the goal is to get the raw frames out of memory rather than to make the files as small as possible.
+    """
+    def __init__(self, compression_level=1, workers=1):
+        self.compression_level = compression_level
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _encode(self, image):
+        ok, data = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, self.compression_level])
+        if not ok:
+            raise ValueError("Failed to encode the image as PNG")
+        return data.tobytes()
+
+    def retain(self, image):
+        """
+        Starts encoding the image and returns a CompressedImage. The raw image is released once it has been encoded.
+        """
+        return CompressedImage(self._executor.submit(self._encode, image), image)
+
+    def close(self):
+        self._executor.shutdown()
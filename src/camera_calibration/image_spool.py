@@ -0,0 +1,59 @@
+"""
+Keeping every accepted full-resolution frame in memory doesn't scale to long sessions
+(fifty 20 MP color frames is already about 3 GB). The image spool writes the accepted frames
+to a file and hands back memory-mapped views of them, so pixels are only paged in when something
+(the GUI, saving, re-detection) actually reads them, and the OS can drop them again afterwards.
+"""
+import mmap
+import os
+import tempfile
+import numpy as np
+
+class ImageSpool:
+    """
+    An append-only file of raw image data. put() writes an image to the end of the file and returns
+    a copy-on-write np.memmap of it, which can be used anywhere the original array was used.
+    If no path is given, a temporary file is used and deleted when the spool is closed.
+    """
+    def __init__(self, path=None):
+        self._temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="camera_calibration_", suffix=".spool")
+            os.close(fd)
+        self.path = path
+        self._file = open(path, "w+b")
+        self._size = 0
+        self.n_images = 0
+
+    @property
+    def n_bytes(self):
+        return self._size
+
+    def put(self, image):
+        """
+        Appends the image to the spool and returns a memory-mapped view of it.
+        """
+        image = np.ascontiguousarray(image)
+        # memmap offsets are rounded down to the allocation granularity anyways, so align each image to it
+        offset = -(-self._size // mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+        self._file.seek(offset)
+        self._file.write(image.data)
+        self._file.flush()
+        self._size = offset + image.nbytes
+        self.n_images += 1
+        # Copy-on-write, so that drawing on the image doesn't modify the spool
+        return np.memmap(self._file, dtype=image.dtype, mode="c", offset=offset, shape=image.shape)
+
+    def close(self):
+        self._file.close()
+        if self._temporary:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
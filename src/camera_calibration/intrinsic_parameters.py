@@ -15,6 +15,17 @@ class IntrinsicParameters:
     cx: float
     cy: float
     distortion_coefficients: list[float]
+    rms: float = None # the RMS reprojection error (in pixels) of the calibration, if known
+    dropped_views: list[int] = None # the samples that robust calibration rejected as outliers
+    n_rounds: int = None # the number of solves robust calibration took
+
+    @property
+    def camera_matrix(self):
+        return np.array([
+            [self.fx, 0, self.cx],
+            [0, self.fy, self.cy],
+            [0, 0, 1]
+        ])
 
     def __str__(self):
         def format_mat(x, precision=5):
@@ -1,5 +1,11 @@
+import math
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import cv2
+import numpy as np
 from abc import ABC, abstractmethod
+from camera_calibration.image_pyramid import ImagePyramid, to_gray
+
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1)
 
 class Pattern(ABC):
     """
@@ -8,15 +14,248 @@ class Pattern(ABC):
     Each Pattern has an associated function that OpenCV uses to detect the points, as well as 
     a method to draw the pattern on an image.
     """
+    # Whether detection should run on the downsampled image. Patterns that are cheap to detect
+    # at full resolution (or whose points can't be refined with cornerSubPix) set this to False.
+    downsample = True
+
     def __init__(self, n_rows, n_cols, square_size):
         self.n_rows = n_rows
         self.n_cols = n_cols
         self.square_size = square_size
+        self.max_detection_area = 640 * 480 # images larger than this (in pixels) are downsampled before detection
+        self.tracker = None # set to a RoiTracker to only search near the previous frame's corners
+        self.prefilter = None # set to a PreFilter to reject frames before running the (expensive) detector
+        self.cache = None # set to a DetectionCache to reuse the corners detected in previous runs
+        self.max_refine_radius = 10 # upper bound (in pixels) on the cornerSubPix window radius
+        self._object_points = None
+        # Per-frame time budget (in seconds) for the detector. If set, detection runs in a worker thread,
+        # and frames that go over the budget are counted as misses so that the caller (eg. the GUI) isn't blocked.
+        self.detection_timeout = None
+        self._executor = None
+        self._pending = None # detection that went over the budget and is still running
+
+        # detection stats
+        self.n_frames = 0
+        self.n_found = 0
+        self.n_timeouts = 0 # frames whose detection went over the budget
+        self.n_skipped = 0 # frames that weren't searched because an earlier detection was still running
+
+    def __getstate__(self):
+        # The worker thread can't be pickled (eg. when the pattern is sent to the batch detection processes)
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_pending'] = None
+        return state
 
     @abstractmethod
     def detect_points(self, image):
         pass
 
+    @property
+    def object_points(self):
+        """
+        The (n_points, 3) float32 positions of the pattern points in the pattern frame, in the order they are detected.
+        The template is built once and shared (read-only) by every sample of this pattern.
+        """
+        if self._object_points is None:
+            self._object_points = self.make_object_points()
+            self._object_points.flags.writeable = False
+        return self._object_points
+
+    def make_object_points(self):
+        """
+        Builds the object point grid for a pattern whose points are spaced square_size apart in rows and columns.
+        """
+        rows, cols = np.divmod(np.arange(self.n_rows * self.n_cols), self.n_cols)
+        object_points = np.zeros((self.n_rows * self.n_cols, 3), dtype=np.float32)
+        object_points[:, 0] = cols * self.square_size
+        object_points[:, 1] = rows * self.square_size
+        return object_points
+
+    def detect(self, image, cache_key=None):
+        """
+        Detects the pattern in a frame (an image or ImagePyramid).
+        If there is a cache, frames that were seen before skip detection entirely
+        (cache_key can be passed in if it was already computed, eg. from the encoded image file).
+        Frames are then checked by the pre-filter (if there is one),
+        and the tracker (if there is one) restricts the search to the area around the previous detection.
+        Returns the same values as downsample_and_detect.
+        """
+        frame = ImagePyramid.of(image)
+        result = self._detect(frame, cache_key)
+        self.n_frames += 1
+        if result[1] is not None:
+            self.n_found += 1
+        return result
+
+    def _detect(self, frame, cache_key):
+        if self.cache is not None:
+            if cache_key is None:
+                cache_key = self.cache.key(frame.image, self)
+            hit, corners = self.cache.get(cache_key)
+            if hit:
+                if self.tracker is not None:
+                    self.tracker.update(corners)
+                scrib, scale = self.downsample_image(frame)
+                downsampled_corners = None if corners is None else corners / np.array(scale, dtype=np.float32)
+                return (scrib, corners, downsampled_corners, scale)
+
+        if self.prefilter is not None and not self.prefilter.passes(frame, self):
+            if self.tracker is not None:
+                self.tracker.update(None)
+            scrib, scale = self.downsample_image(frame)
+            return (scrib, None, None, scale)
+
+        if self.detection_timeout is None:
+            result = self._search(frame)
+        else:
+            result = self._search_with_deadline(frame)
+            if result is None:
+                scrib, scale = self.downsample_image(frame)
+                return (scrib, None, None, scale)
+
+        # A miss is only cached after a full search, since the tracker may have searched the wrong region
+        if self.cache is not None and (result[1] is not None or self.tracker is None):
+            self.cache.put(cache_key, result[1])
+        return result
+
+    def _search(self, frame):
+        if self.tracker is not None:
+            return self.tracker.detect(self, frame)
+        return self.downsample_and_detect(frame)
+
+    def _search_with_deadline(self, frame):
+        """
+        Runs the search in the worker thread and waits for at most detection_timeout seconds.
+        Returns None if the frame timed out or was skipped. A detection that times out is abandoned
+        (its result is discarded), and new frames are skipped until it finishes.
+        """
+        if self._pending is not None:
+            if not self._pending.done():
+                self.n_skipped += 1
+                return None
+            self._pending = None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        future = self._executor.submit(self._search, frame)
+        try:
+            return future.result(timeout=self.detection_timeout)
+        except TimeoutError:
+            self._pending = future
+            self.n_timeouts += 1
+            return None
+
+    def print_stats(self):
+        """
+        Prints how many frames were searched and how many of them were misses (including timeouts),
+        along with the pre-filter stats (if there is one).
+        """
+        n_misses = self.n_frames - self.n_found
+        print(f"Searched {self.n_frames} frames: found the pattern in {self.n_found}, missed {n_misses} "
+              f"({self.n_timeouts} timed out, {self.n_skipped} skipped while detection was still running)")
+        if self.prefilter is not None:
+            self.prefilter.print_stats()
+
+    def detect_batch(self, images_or_paths, workers=None, chunksize=4, verbose=True):
+        """
+        Detects the pattern in many images (or image files) across a pool of processes.
+        Returns (found, corners) as packed arrays in the input order; see batch.detect_batch.
+        """
+        from camera_calibration.batch import detect_batch
+        return detect_batch(self, images_or_paths, workers=workers, chunksize=chunksize, verbose=verbose)
+
+    def downsample_image(self, image):
+        """
+        Scales the image (or ImagePyramid) down to approximately max_detection_area pixels.
+        Returns (scrib, (x_scale, y_scale)), where the scales map scrib coordinates back to the image.
+        """
+        return ImagePyramid.of(image).downsample(self.max_detection_area)
+
+    def downsample_and_detect(self, image, max_area=None):
+        """
+        Downsamples the image to approximately VGA resolution (or max_area pixels, if given) and detects
+        the pattern corners in the full-size image.
+
+        Detection is too expensive on large images, so it's better to detect on the small image
+        and refine the up-scaled corners in the full-resolution image (as in image_pipeline).
+        The downsampled image and corners are returned as well so that they can be displayed
+        without being rescaled again.
+
+        Returns (scrib, corners, downsampled_corners, (x_scale, y_scale)).
+        The corners are None if the pattern was not found.
+        """
+        frame = ImagePyramid.of(image)
+        if max_area is None:
+            max_area = self.max_detection_area
+        scrib, (x_scale, y_scale) = frame.downsample(max_area)
+        scale = max(x_scale, y_scale)
+
+        corners = None
+        downsampled_corners = None
+        if self.downsample:
+            ok, points = self.detect_points(frame.downsample_gray(max_area)[0])
+            if ok:
+                downsampled_corners = points.reshape(-1, 1, 2).astype(np.float32)
+                if scale > 1.0:
+                    # Refine the up-scaled corners in the original full-res image.
+                    # The up-scaling error is about one downsampled pixel, so there's no need to search further than that.
+                    corners = downsampled_corners * np.array([x_scale, y_scale], dtype=np.float32)
+                    self.refine_points(frame.gray, corners, max_radius=int(math.ceil(scale)) + 1)
+                else:
+                    corners = downsampled_corners
+        else:
+            ok, points = self.detect_points(frame.gray)
+            if ok:
+                corners = points.reshape(-1, 1, 2).astype(np.float32)
+                # Scale the corners to the downsampled image for display
+                downsampled_corners = corners / np.array([x_scale, y_scale], dtype=np.float32)
+
+        return (scrib, corners, downsampled_corners, (x_scale, y_scale))
+
+    def refine_window_radius(self, corners, max_radius=None):
+        """
+        Returns the cornerSubPix window radius for a detection: half the minimum distance between
+        neighbouring corners (as in image_pipeline), which is large enough to snap to the correct corner
+        but not so large as to include a wrong corner in the window. The radius is capped at max_radius
+        (default max_refine_radius), since a window spanning a whole square on a high-resolution image
+        is expensive and doesn't make the corners any more accurate.
+        """
+        points = corners.reshape(-1, 2)
+        if len(points) == self.n_rows * self.n_cols:
+            grid = points.reshape(self.n_rows, self.n_cols, 2)
+            spacing = min(np.linalg.norm(np.diff(grid, axis=0), axis=2).min(),
+                          np.linalg.norm(np.diff(grid, axis=1), axis=2).min())
+        else:
+            # partial detection, so the grid neighbours are unknown
+            spacing = np.linalg.norm(np.diff(points, axis=0), axis=1).min()
+        if max_radius is None:
+            max_radius = self.max_refine_radius
+        return int(max(2, min(math.ceil(0.5 * spacing), max_radius)))
+
+    def refine_points(self, gray, corners, max_radius=None):
+        """
+        Refines all of the corners of one detection (in place) with a single cornerSubPix call,
+        using a window sized from the measured corner spacing.
+        """
+        radius = self.refine_window_radius(corners, max_radius)
+        cv2.cornerSubPix(gray, corners, (radius, radius), (-1, -1), SUBPIX_CRITERIA)
+        return corners
+
+    def refine_samples(self, samples, workers=None):
+        """
+        Refines the pixel points of many samples (in place) in a thread pool.
+        cornerSubPix releases the GIL, so the samples are refined in parallel.
+        This only changes the samples' pixel_points: to refine samples that were already added to a calibrator
+        (whose store keeps its own copy of the points), use Calibrator.refine_samples.
+        """
+        def refine(sample):
+            if sample.pixel_points is not None:
+                sample.pixel_points = np.ascontiguousarray(sample.pixel_points, dtype=np.float32).reshape(-1, 1, 2)
+                self.refine_points(sample.gray, sample.pixel_points)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(refine, samples))
+
     # TODO: should this method be here, or since it is drawing points is it ok to put it somewhere else?
     # For now I'll keep it here, because theoretically it seems like there could be patterns that are not grids.
     def draw(self, image, corners, ret):
@@ -35,19 +274,90 @@ class Chessboard(Pattern):
         raise NotImplementedError("Chessboard is not implemented yet")
 
     def detect_points(self, image):
-        # TODO: Add sub-pixel detection as in image_pipeline
-        return cv2.findChessboardCorners(image, (self.n_cols, self.n_rows), None)
+        # findChessboardCorners is only accurate to about a pixel, so refine the corners as in image_pipeline
+        gray = to_gray(image)
+        ok, corners = cv2.findChessboardCorners(gray, (self.n_cols, self.n_rows),
+                                                flags=cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE)
+        if ok:
+            corners = self.refine_points(gray, corners)
+        return ok, corners
     
     def draw(self, image, corners, ret):
         return cv2.drawChessboardCorners(image, (self.n_cols, self.n_rows), corners, ret)
 
 class AcirclesGrid(Pattern):
+    # Circle grid detection is fast even on large images, and the circle centers can't be refined with cornerSubPix
+    downsample = False
+
     def __init__(self, n_rows, n_cols, square_size):
         super().__init__(n_rows, n_cols, square_size)
         raise NotImplementedError("AcirclesGrid is not implemented yet")
 
     def detect_points(self, image):
         return cv2.findAcirclesGrid(image, (self.n_cols, self.n_rows), None)
+
+    def make_object_points(self):
+        # Every other row of circles is offset by half a column
+        rows, cols = np.divmod(np.arange(self.n_rows * self.n_cols), self.n_cols)
+        object_points = np.zeros((self.n_rows * self.n_cols, 3), dtype=np.float32)
+        object_points[:, 0] = (2 * cols + rows % 2) * self.square_size
+        object_points[:, 1] = rows * self.square_size
+        return object_points
     
     def draw(self, image, corners, ret):
         return cv2.drawChessboardCorners(image, (self.n_cols, self.n_rows), corners, ret)
+
+class MultiPatternDetector:
+    """
+    Searches every frame for several patterns (eg. the patterns given on the command line) in one pass.
+    The grayscale image, the downsampled levels and the shared pre-filter are computed once per frame
+    and reused for every pattern. The pattern that matched most recently is tried first, so when only
+    max_boards boards are wanted the search usually stops after the first pattern.
+    """
+    def __init__(self, patterns, max_boards=None):
+        self.patterns = list(patterns)
+        self.max_boards = max_boards # stop after finding this many boards (None searches for every pattern)
+        self.max_display_area = 640 * 480
+        # Gates that don't depend on the pattern (eg. blur and contrast) are run once per frame.
+        # Pattern-specific gates belong on each pattern's own pre-filter.
+        self.prefilter = None
+        self._order = list(range(len(self.patterns))) # most recently matched first
+
+    @property
+    def prefilter(self):
+        return self._prefilter
+
+    @prefilter.setter
+    def prefilter(self, prefilter):
+        if prefilter is not None:
+            for gate in prefilter.gates:
+                if gate.uses_pattern:
+                    raise ValueError(f"The {gate.name} gate depends on the pattern, so it can't be in the shared pre-filter; "
+                                     "add it to each pattern's pre-filter instead")
+        self._prefilter = prefilter
+
+    def detect(self, image):
+        """
+        Detects every pattern in the frame (an image or ImagePyramid).
+        Returns (scrib, detections, (x_scale, y_scale)), where detections is a list of
+        (pattern, corners, downsampled_corners) in the order that the patterns were found.
+        The downsampled corners are relative to scrib.
+        """
+        frame = ImagePyramid.of(image)
+        scrib, scale = frame.downsample(self.max_display_area)
+        detections = []
+        if self.prefilter is not None and not self.prefilter.passes(frame, None):
+            return (scrib, detections, scale)
+
+        for i in list(self._order):
+            pattern = self.patterns[i]
+            _, corners, _, _ = pattern.detect(frame)
+            if corners is None:
+                continue
+            downsampled_corners = corners / np.array(scale, dtype=np.float32)
+            detections.append((pattern, corners, downsampled_corners))
+            self._order.remove(i)
+            self._order.insert(len(detections) - 1, i)
+            if self.max_boards is not None and len(detections) >= self.max_boards:
+                break
+        return (scrib, detections, scale)
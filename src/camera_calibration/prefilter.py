@@ -0,0 +1,132 @@
+"""
+findChessboardCornersSB is slow on frames that don't contain the pattern, which is most frames
+while the operator is walking around. The pre-filter is a series of cheap gates that run on the
+downsampled frame, and only frames that pass every gate are handed to the expensive detector.
+Each gate keeps track of how often it rejects a frame and how long it takes, so that the
+thresholds can be tuned per camera.
+"""
+import time
+from abc import ABC, abstractmethod
+import cv2
+import numpy as np
+
+class Gate(ABC):
+    """
+    A cheap test that a frame must pass before the pattern is searched for.
+    """
+    name = "gate"
+    # Whether the gate looks at the pattern, so that it can't be used where there is no single pattern
+    # (eg. the shared pre-filter of a MultiPatternDetector)
+    uses_pattern = False
+
+    def __init__(self, max_area=640 * 480):
+        self.max_area = max_area # the gate runs on the frame downsampled to approximately this many pixels
+        self.n_checked = 0
+        self.n_rejected = 0
+        self.total_time = 0.0
+
+    @abstractmethod
+    def passes(self, frame, pattern):
+        """
+        Returns True if the frame (an ImagePyramid) might contain the pattern.
+        """
+        pass
+
+    def __call__(self, frame, pattern):
+        start = time.perf_counter()
+        passed = self.passes(frame, pattern)
+        self.total_time += time.perf_counter() - start
+        self.n_checked += 1
+        if not passed:
+            self.n_rejected += 1
+        return passed
+
+    @property
+    def rejection_rate(self):
+        return self.n_rejected / self.n_checked if self.n_checked else 0.0
+
+    @property
+    def mean_time_ms(self):
+        return 1000 * self.total_time / self.n_checked if self.n_checked else 0.0
+
+    def reset_stats(self):
+        self.n_checked = 0
+        self.n_rejected = 0
+        self.total_time = 0.0
+
+class BlurGate(Gate):
+    """
+    Rejects blurry frames (eg. from motion), using the variance of the Laplacian as a sharpness measure.
+    """
+    name = "blur"
+
+    def __init__(self, min_laplacian_variance=50.0, max_area=640 * 480):
+        super().__init__(max_area)
+        self.min_laplacian_variance = min_laplacian_variance
+
+    def passes(self, frame, pattern):
+        gray, _ = frame.downsample_gray(self.max_area)
+        return cv2.Laplacian(gray, cv2.CV_32F).var() >= self.min_laplacian_variance
+
+class ContrastGate(Gate):
+    """
+    Rejects frames without enough contrast to contain the pattern (eg. a blank wall),
+    and frames where too many pixels are saturated (over- or under-exposed).
+    """
+    name = "contrast"
+
+    def __init__(self, min_std=20.0, max_saturated_fraction=0.8, max_area=640 * 480):
+        super().__init__(max_area)
+        self.min_std = min_std
+        self.max_saturated_fraction = max_saturated_fraction
+
+    def passes(self, frame, pattern):
+        gray, _ = frame.downsample_gray(self.max_area)
+        _, std = cv2.meanStdDev(gray)
+        if std[0, 0] < self.min_std:
+            return False
+        if gray.dtype == np.uint8:
+            n_saturated = np.count_nonzero(gray == 0) + np.count_nonzero(gray == 255)
+            if n_saturated > self.max_saturated_fraction * gray.size:
+                return False
+        return True
+
+class CoarseDetectionGate(Gate):
+    """
+    Runs the classic findChessboardCorners with CALIB_CB_FAST_CHECK on a small copy of the frame,
+    which quickly rejects frames that have no chessboard in them.
+    Note that this may also reject frames with a board that is too small to be found at this resolution.
+    """
+    name = "coarse detection"
+    uses_pattern = True
+
+    def __init__(self, max_area=640 * 480):
+        super().__init__(max_area)
+
+    def passes(self, frame, pattern):
+        gray, _ = frame.downsample_gray(self.max_area)
+        ok, _ = cv2.findChessboardCorners(gray, (pattern.n_cols, pattern.n_rows),
+                                          flags=cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK)
+        return ok
+
+class PreFilter:
+    """
+    Runs the gates in order, stopping at the first one that rejects the frame
+    (so the cheapest gates should come first).
+    """
+    def __init__(self, gates=None):
+        if gates is None:
+            gates = [ContrastGate(), BlurGate()]
+        self.gates = gates
+
+    def passes(self, frame, pattern):
+        return all(gate(frame, pattern) for gate in self.gates)
+
+    def reset_stats(self):
+        for gate in self.gates:
+            gate.reset_stats()
+
+    def print_stats(self):
+        print("Pre-filter gate        checked  rejected   rate  mean time")
+        for gate in self.gates:
+            print(f"{gate.name:<20} {gate.n_checked:>9} {gate.n_rejected:>9} {100 * gate.rejection_rate:>5.1f}% {gate.mean_time_ms:>7.2f} ms")
@@ -2,28 +2,153 @@
 A Sample contains
 1. The raw data of the image(s) and any additional data (eg. pose for extrinsic calibration)
 2. The processed points that were detected in the image(s)
+3. Lazily computed grayscale and downsampled views of the image(s), which are shared between
+   detection, refinement and display so that each frame is only converted once
 """
-from dataclasses import dataclass
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+import cv2
 import numpy as np
+from camera_calibration.image_pyramid import ImagePyramid
+
+class LazyImage(ABC):
+    """
+    An image that is only loaded (eg. decoded) when a sample's image is read.
+    """
+    @abstractmethod
+    def load(self):
+        pass
+
+class FileImage(LazyImage):
+    """
+    An encoded image (eg. a PNG) in a file, which is only read and decoded when it is loaded.
+    offset and n_bytes locate the image inside a larger file, eg. a member of an uncompressed
+    tar archive (TarInfo.offset_data and TarInfo.size) or a record of a session journal.
+    """
+    def __init__(self, path, offset=0, n_bytes=-1):
+        self.path = path
+        self.offset = offset
+        self.n_bytes = n_bytes
+
+    @property
+    def data(self):
+        """
+        The encoded bytes of the image.
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            return f.read(self.n_bytes)
+
+    def load(self):
+        return cv2.imdecode(np.frombuffer(self.data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+class _ImageField:
+    """
+    Descriptor for the image fields of a sample. The stored value may be an array or a LazyImage,
+    which is loaded every time the field is read (so the pixels aren't kept in memory).
+    """
+    def __set_name__(self, owner, name):
+        self._attribute = '_' + name
+
+    def __get__(self, sample, owner=None):
+        if sample is None:
+            return None # the default value of the dataclass field
+        value = sample.__dict__.get(self._attribute)
+        if isinstance(value, LazyImage):
+            return value.load()
+        return value
+
+    def __set__(self, sample, value):
+        sample.__dict__[self._attribute] = value
+
+def _pyramid(cached, source, load):
+    """
+    Returns the cached (source, pyramid) pair if it still belongs to the image source, otherwise a new one.
+    """
+    if source is None:
+        return None
+    if cached is None or cached[0] is not source:
+        if isinstance(source, LazyImage):
+            # Don't keep the decoded image (or its grayscale version) for the lifetime of the sample
+            return (source, ImagePyramid.lazy(load))
+        return (source, ImagePyramid(load()))
+    return cached
 
 @dataclass
-class MonoSample:
-    image: np.ndarray
-    pixel_points: np.ndarray # 2D points in the image
-    world_points: np.ndarray # Scaled 3D points from the target
+class Sample:
+    """
+    The world points of a sample aren't stored on the sample: they are the same for every sample
+    of a pattern, so each sample refers to its pattern's shared object point template instead
+    (and, for partial detections, the ids of the visible points).
+    """
+    @property
+    def world_points(self):
+        """
+        Scaled 3D points from the target, corresponding to the pixel points.
+        """
+        if self.pattern is None:
+            return None
+        if self.point_ids is None:
+            return self.pattern.object_points
+        return self.pattern.object_points[self.point_ids]
+
+    def raw_image(self, name='image'):
+        """
+        Returns what is stored for an image field (eg. a LazyImage) without loading it.
+        """
+        return self.__dict__.get('_' + name)
+
+@dataclass
+class MonoSample(Sample):
+    image: np.ndarray = _ImageField()
+    pixel_points: np.ndarray = None # 2D points in the image
+    pattern: object = None # the Pattern that the points were detected from
+    point_ids: np.ndarray = None # indices of the visible pattern points (None if the whole pattern is visible)
+    _pyramid: tuple = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def pyramid(self):
+        self._pyramid = _pyramid(self._pyramid, self.raw_image(), lambda: self.image)
+        return self._pyramid[1]
+
+    @property
+    def gray(self):
+        return self.pyramid.gray
 
 @dataclass
 class StereoSample(Sample):
-    left_image: np.ndarray
-    right_image: np.ndarray
-    left_pixel_points: np.ndarray
-    right_pixel_points: np.ndarray
-    world_points: np.ndarray
+    left_image: np.ndarray = _ImageField()
+    right_image: np.ndarray = _ImageField()
+    left_pixel_points: np.ndarray = None
+    right_pixel_points: np.ndarray = None
+    pattern: object = None
+    point_ids: np.ndarray = None
+    _left_pyramid: tuple = field(default=None, init=False, repr=False, compare=False)
+    _right_pyramid: tuple = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def left_pyramid(self):
+        self._left_pyramid = _pyramid(self._left_pyramid, self.raw_image('left_image'), lambda: self.left_image)
+        return None if self._left_pyramid is None else self._left_pyramid[1]
+
+    @property
+    def right_pyramid(self):
+        self._right_pyramid = _pyramid(self._right_pyramid, self.raw_image('right_image'), lambda: self.right_image)
+        return None if self._right_pyramid is None else self._right_pyramid[1]
+
+    @property
+    def left_gray(self):
+        return None if self.raw_image('left_image') is None else self.left_pyramid.gray
+
+    @property
+    def right_gray(self):
+        return None if self.raw_image('right_image') is None else self.right_pyramid.gray
 
 
 @dataclass
 class HandEyeSample(Sample):
     image: np.ndarray
     pixel_points: np.ndarray
-    world_points: np.ndarray
     pose: np.ndarray
+    pattern: object = None
+    point_ids: np.ndarray = None
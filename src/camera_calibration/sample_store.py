@@ -0,0 +1,165 @@
+"""
+At calibration time OpenCV needs the points of every sample as float32 arrays.
+Rather than rebuilding those arrays from the samples one point at a time, the SampleStore
+keeps the pixel points of all samples in one preallocated array and hands out views of it.
+"""
+import time
+import numpy as np
+
+class SampleStore:
+    """
+    Stores the pixel points of all samples in a growable float32 array of shape (capacity, n_points, 2),
+    with per-sample metadata in parallel arrays. Partial detections (with fewer than n_points points)
+    are stored at the start of their row, and n_visible records how many of the points are valid.
+    Indexing the store returns the sample objects (eg. for their images), in the order they were added.
+
+    The store also keeps each sample's view parameters [X, Y, size, skew] (each in [0, 1]) and a histogram
+    of them with n_param_bins bins per parameter. The histogram is updated as samples are added and removed,
+    and is used to find the sample that contributes least to the coverage of the views.
+    """
+    def __init__(self, n_points=None, capacity=64, n_param_bins=8):
+        self.n_points = n_points # points per sample, taken from the first sample if not given
+        self.n_param_bins = n_param_bins
+        self._capacity = capacity
+        self._size = 0
+        self._points = None
+        self._n_visible = np.zeros(capacity, dtype=np.int32)
+        self._timestamps = np.zeros(capacity, dtype=np.float64)
+        self._params = np.full((capacity, 4), np.nan, dtype=np.float32)
+        self._param_bins = np.zeros((capacity, 4), dtype=np.int32)
+        self._param_bin_counts = np.zeros((4, n_param_bins), dtype=np.int32)
+        self._samples = []
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        return self._samples[index]
+
+    def __iter__(self):
+        return iter(self._samples)
+
+    @property
+    def points(self):
+        """
+        A view of the (n_samples, n_points, 2) pixel points.
+        """
+        if self._points is None:
+            return np.empty((0, 0, 2), dtype=np.float32)
+        return self._points[:self._size]
+
+    @property
+    def n_visible(self):
+        return self._n_visible[:self._size]
+
+    @property
+    def timestamps(self):
+        return self._timestamps[:self._size]
+
+    @property
+    def params(self):
+        """
+        The (n_samples, 4) view parameters [X, Y, size, skew], NaN for samples added without them.
+        """
+        return self._params[:self._size]
+
+    @property
+    def param_bin_counts(self):
+        """
+        The (4, n_param_bins) histogram of the view parameters.
+        """
+        return self._param_bin_counts
+
+    def _grow(self, capacity):
+        points = np.empty((capacity, self.n_points, 2), dtype=np.float32)
+        points[:self._size] = self._points[:self._size]
+        self._points = points
+        self._n_visible = np.resize(self._n_visible, capacity)
+        self._timestamps = np.resize(self._timestamps, capacity)
+        self._params = np.resize(self._params, (capacity, 4))
+        self._param_bins = np.resize(self._param_bins, (capacity, 4))
+        self._capacity = capacity
+
+    def append(self, sample, pixel_points=None, params=None):
+        """
+        Adds a sample, copying its pixel points (sample.pixel_points unless given) and view parameters into the store.
+        Returns the index of the sample.
+        """
+        if pixel_points is None:
+            pixel_points = sample.pixel_points
+        pixel_points = np.asarray(pixel_points, dtype=np.float32).reshape(-1, 2)
+        if self._points is None:
+            if self.n_points is None:
+                self.n_points = len(pixel_points)
+            self._points = np.empty((self._capacity, self.n_points, 2), dtype=np.float32)
+        if len(pixel_points) > self.n_points:
+            raise ValueError(f"Sample has {len(pixel_points)} points, but the store only holds {self.n_points} per sample")
+        if self._size == self._capacity:
+            self._grow(2 * self._capacity)
+
+        index = self._size
+        self._points[index, :len(pixel_points)] = pixel_points
+        self._n_visible[index] = len(pixel_points)
+        self._timestamps[index] = time.time()
+        if params is None:
+            self._params[index] = np.nan
+            self._param_bins[index] = -1
+        else:
+            self._params[index] = params
+            self._param_bins[index] = np.clip((np.asarray(params) * self.n_param_bins).astype(np.int32), 0, self.n_param_bins - 1)
+            self._param_bin_counts[np.arange(4), self._param_bins[index]] += 1
+        self._samples.append(sample)
+        self._size += 1
+        return index
+
+    def remove(self, index):
+        """
+        Removes the sample at index (shifting the later samples down) and returns it.
+        """
+        if index < 0:
+            index += self._size
+        if self._param_bins[index, 0] >= 0:
+            self._param_bin_counts[np.arange(4), self._param_bins[index]] -= 1
+        for array in (self._points, self._n_visible, self._timestamps, self._params, self._param_bins):
+            array[index:self._size - 1] = array[index + 1:self._size]
+        self._size -= 1
+        return self._samples.pop(index)
+
+    def pop(self):
+        return self.remove(self._size - 1)
+
+    def update_points(self, index, pixel_points):
+        """
+        Replaces the stored pixel points of the sample at index (eg. after refining them).
+        The number of points must stay the same.
+        """
+        if index < 0:
+            index += self._size
+        pixel_points = np.asarray(pixel_points, dtype=np.float32).reshape(-1, 2)
+        if len(pixel_points) != self._n_visible[index]:
+            raise ValueError(f"Sample {index} has {self._n_visible[index]} points, got {len(pixel_points)}")
+        self._points[index, :len(pixel_points)] = pixel_points
+
+    def least_valuable(self):
+        """
+        Returns the index of the sample whose removal would hurt the coverage of the views the least.
+        Each sample is scored by how crowded its bins are: a sample that is alone in one of its bins
+        can't be removed without losing coverage, while one whose bins are full of other samples can.
+        Samples added without view parameters are never chosen over samples with them.
+        """
+        bins = self._param_bins[:self._size]
+        has_params = bins[:, 0] >= 0
+        if not np.any(has_params):
+            return 0
+        counts = self._param_bin_counts[np.arange(4), np.maximum(bins, 0)]
+        cost = np.where(has_params, (1.0 / np.maximum(counts, 1)).sum(axis=1), np.inf)
+        return int(np.argmin(cost))
+
+    def image_points(self, indices=None):
+        """
+        Returns the pixel points of each sample (or only the given samples) as (n_visible, 1, 2) views
+        into the store, which can be passed to cv2.calibrateCamera without copying.
+        """
+        if indices is None:
+            indices = range(self._size)
+        return [self._points[i, :self._n_visible[i]].reshape(-1, 1, 2) for i in indices]
@@ -0,0 +1,115 @@
+"""
+When detection is slower than the camera, frames pile up in the capture buffer and the
+latency between the camera and the GUI keeps growing. The scheduler reads frames in a
+background thread and only ever hands out the newest one, dropping the stale frames.
+"""
+import threading
+import time
+
+class FrameScheduler:
+    """
+    Sits between a frame source (eg. cv2.VideoCapture.read) and the calibrator.
+    Iterating over the scheduler yields (frame, detect) for the newest frame, where detect says whether
+    detection should run on this frame. Detection is scheduled from the measured detection latency so that
+    it takes up at most max_detection_fraction of the time; the remaining frames are only for display.
+    """
+    def __init__(self, read_frame, max_detection_fraction=1.0, latency_smoothing=0.2):
+        self.read_frame = read_frame # returns (ret, frame), like cv2.VideoCapture.read
+        self.max_detection_fraction = max_detection_fraction
+        self.latency_smoothing = latency_smoothing # weight of the newest measurement in the latency average
+        self.detection_latency = None # seconds (exponential moving average)
+
+        self.n_captured = 0
+        self.n_dropped = 0
+        self.n_processed = 0
+        self.n_detected = 0
+
+        self._condition = threading.Condition()
+        self._frame = None
+        self._sequence = 0 # sequence number of the newest frame
+        self._last_sequence = 0 # sequence number of the last frame that was handed out
+        self._running = False
+        self._thread = None
+        self._next_detection_time = 0.0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._capture, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _capture(self):
+        while self._running:
+            ret, frame = self.read_frame()
+            with self._condition:
+                if not ret:
+                    self._running = False
+                else:
+                    self._frame = frame
+                    self._sequence += 1
+                    self.n_captured += 1
+                self._condition.notify_all()
+
+    def next_frame(self, timeout=None):
+        """
+        Waits for a frame newer than the last one that was handed out and returns it
+        (or None if the source has stopped). Frames that were skipped over are counted as dropped.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._sequence > self._last_sequence or not self._running, timeout)
+            if self._sequence == self._last_sequence:
+                return None
+            self.n_dropped += self._sequence - self._last_sequence - 1
+            self._last_sequence = self._sequence
+            self.n_processed += 1
+            return self._frame
+
+    def should_detect(self):
+        return time.perf_counter() >= self._next_detection_time
+
+    def record_detection(self, latency):
+        """
+        Updates the detection latency and schedules the next detection so that detection
+        takes up at most max_detection_fraction of the time.
+        """
+        if self.detection_latency is None:
+            self.detection_latency = latency
+        else:
+            self.detection_latency += self.latency_smoothing * (latency - self.detection_latency)
+        self.n_detected += 1
+        idle_time = self.detection_latency * (1.0 / self.max_detection_fraction - 1.0)
+        self._next_detection_time = time.perf_counter() + idle_time
+
+    def __iter__(self):
+        """
+        Yields (frame, detect) until the source stops. The time between yielding a frame with detect=True
+        and the next iteration is measured as the detection latency.
+        """
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            detect = self.should_detect()
+            start = time.perf_counter()
+            yield frame, detect
+            if detect:
+                self.record_detection(time.perf_counter() - start)
+
+    def print_stats(self):
+        latency = "n/a" if self.detection_latency is None else f"{1000 * self.detection_latency:.1f} ms"
+        print(f"Captured {self.n_captured} frames: processed {self.n_processed}, dropped {self.n_dropped}, "
+              f"ran detection on {self.n_detected} (detection latency {latency})")
@@ -0,0 +1,204 @@
+"""
+The samples collected in a session are only saved when the calibrator quits, so they are all
+lost if the process dies. The session journal appends every accepted sample (its points, view
+parameters and optionally its encoded image) to chunk files as it arrives, so the calibrator
+state can be rebuilt from the journal without detecting anything again.
+
+Each chunk file is a sequence of records: an 8-byte little-endian header length, a JSON header,
+then the payload (the float32 pixel points followed by the encoded image, if any).
+A record that was only partially written (eg. because of a crash) ends the replay of its chunk.
+"""
+import json
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from camera_calibration.sample import LazyImage, FileImage, MonoSample
+
+_HEADER_LENGTH = struct.Struct("<Q")
+
+class SessionJournal:
+    """
+    An append-only journal of the samples accepted (and removed) in a session, stored in a directory.
+    Records are written by a background thread and flushed to the OS straight away (so they survive the process
+    dying), while the chunk file is fsynced after every fsync_every records or fsync_interval seconds after the
+    first unsynced record (whichever comes first), rather than after every record.
+    """
+    def __init__(self, directory, save_images=True, chunk_bytes=256 * 2**20,
+                 fsync_every=16, fsync_interval=2.0, png_compression=1):
+        self.directory = directory
+        self.save_images = save_images
+        self.chunk_bytes = chunk_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.png_compression = png_compression
+        os.makedirs(directory, exist_ok=True)
+
+        # Continue after any existing chunks (eg. when resuming), without touching them
+        chunks = self.chunk_paths()
+        self._chunk_index = len(chunks)
+        self._next_id = 0
+        for record, _ in self.replay(include_removals=True):
+            self._next_id = max(self._next_id, record["id"] + 1)
+
+        self._file = None
+        self._n_unsynced = 0
+        self._last_sync = time.monotonic()
+        self._sync_timer = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def chunk_paths(self):
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.startswith("chunk_") and name.endswith(".journal"))
+
+    def _open_chunk(self):
+        path = os.path.join(self.directory, f"chunk_{self._chunk_index:05d}.journal")
+        self._chunk_index += 1
+        self._file = open(path, "ab")
+
+    def _write(self, header, payload=b""):
+        if self._file is None or self._file.tell() >= self.chunk_bytes:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+            self._open_chunk()
+        header = json.dumps(header).encode()
+        self._file.write(_HEADER_LENGTH.pack(len(header)) + header + payload)
+        # Flushing is cheap, and is enough for the record to survive a crash of the process (but not of the OS)
+        self._file.flush()
+        self._n_unsynced += 1
+        if self._n_unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self._sync()
+        elif self._sync_timer is None:
+            # Sync the last records even if no more records arrive
+            self._sync_timer = threading.Timer(self.fsync_interval, self._submit_timed_sync)
+            self._sync_timer.daemon = True
+            self._sync_timer.start()
+
+    def _submit_timed_sync(self):
+        try:
+            self._executor.submit(self._timed_sync)
+        except RuntimeError:
+            pass # the journal was closed, which syncs
+
+    def _timed_sync(self):
+        self._sync_timer = None
+        self._sync()
+
+    def _sync(self):
+        if self._file is not None and self._n_unsynced > 0:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._n_unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _encode(self, sample):
+        raw_image = sample.raw_image()
+        if raw_image is None or not self.save_images:
+            return b""
+        if isinstance(raw_image, LazyImage):
+            if hasattr(raw_image, "data"):
+                return raw_image.data # already encoded (eg. by CompressedRetention)
+            raw_image = raw_image.load()
+        ok, data = cv2.imencode(".png", raw_image, [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression])
+        return data.tobytes() if ok else b""
+
+    def _write_sample(self, record_id, sample, params, image_size):
+        points = np.ascontiguousarray(sample.pixel_points, dtype=np.float32).reshape(-1, 2)
+        image = self._encode(sample)
+        header = {
+            "type": "sample",
+            "id": record_id,
+            "timestamp": time.time(),
+            "n_points": len(points),
+            "params": None if params is None else [float(p) for p in params],
+            "point_ids": None if sample.point_ids is None else np.asarray(sample.point_ids).tolist(),
+            "image_size": None if image_size is None else list(image_size),
+            "image_bytes": len(image),
+        }
+        self._write(header, points.tobytes() + image)
+
+    def record_sample(self, sample, params=None, image_size=None):
+        """
+        Queues an accepted sample to be written, and returns its id in the journal.
+        """
+        record_id = self._next_id
+        self._next_id += 1
+        self._executor.submit(self._write_sample, record_id, sample, params, image_size)
+        return record_id
+
+    def record_removal(self, record_id):
+        """
+        Queues a record that the sample with the given id was removed.
+        """
+        self._executor.submit(self._write, {"type": "remove", "id": record_id, "timestamp": time.time()})
+
+    def flush(self):
+        """
+        Waits for the queued records to be written, then fsyncs the current chunk.
+        """
+        self._executor.submit(self._sync).result()
+
+    def close(self):
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+        self.flush()
+        self._executor.shutdown()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def replay(self, include_removals=False):
+        """
+        Yields (header, payload_offset) for every record in the journal, along with the path of its chunk
+        in header["chunk"]. Unless include_removals is True, only the samples that are still in the session
+        (ie. weren't removed later) are yielded, in the order they were added.
+        """
+        records = {}
+        for path in self.chunk_paths():
+            with open(path, "rb") as f:
+                while True:
+                    length = f.read(_HEADER_LENGTH.size)
+                    if len(length) < _HEADER_LENGTH.size:
+                        break
+                    (length,) = _HEADER_LENGTH.unpack(length)
+                    header = f.read(length)
+                    try:
+                        header = json.loads(header)
+                    except ValueError:
+                        break # partially written record
+                    offset = f.tell()
+                    payload_bytes = 8 * header.get("n_points", 0) + header.get("image_bytes", 0)
+                    f.seek(payload_bytes, os.SEEK_CUR)
+                    if f.tell() > os.fstat(f.fileno()).st_size:
+                        break
+                    header["chunk"] = path
+                    if include_removals:
+                        yield header, offset
+                    elif header["type"] == "sample":
+                        records[header["id"]] = (header, offset)
+                    elif header["type"] == "remove":
+                        records.pop(header["id"], None)
+        if not include_removals:
+            yield from records.values()
+
+    def load_samples(self, pattern=None):
+        """
+        Yields (sample, params, image_size, record_id) for every sample still in the session. The points are read
+        from the journal, and the images are FileImages that are only decoded if they are used.
+        """
+        for header, offset in self.replay():
+            with open(header["chunk"], "rb") as f:
+                f.seek(offset)
+                points = np.frombuffer(f.read(8 * header["n_points"]), dtype=np.float32).reshape(-1, 1, 2).copy()
+            image = None
+            if header["image_bytes"] > 0:
+                image = FileImage(header["chunk"], offset + 8 * header["n_points"], header["image_bytes"])
+            point_ids = None if header["point_ids"] is None else np.array(header["point_ids"])
+            sample = MonoSample(image, points, pattern, point_ids)
+            params = None if header["params"] is None else np.array(header["params"], dtype=np.float32)
+            image_size = None if header["image_size"] is None else tuple(header["image_size"])
+            yield sample, params, image_size, header["id"]
@@ -0,0 +1,90 @@
+"""
+Deciding whether a new view is a near-duplicate of a stored sample means finding the stored view
+whose parameters [X, Y, size, skew] are closest to it. Comparing against every stored sample is O(N)
+on every frame, so the parameters are kept in a uniform grid hash instead, and only the cells around
+the new view are searched.
+"""
+import itertools
+import math
+import numpy as np
+
+class GridIndex:
+    """
+    A uniform grid hash over points in a low-dimensional space (eg. the 4-D view parameters).
+    The cells are cell_size wide, so any point within cell_size (in L1 or any other norm at least
+    as large as the max norm) of a query lies in the query's cell or one of its neighbours.
+    Searches for larger distances cover ceil(distance / cell_size) cells in each direction.
+    Points are identified by hashable keys, so they can be removed again.
+    """
+    def __init__(self, n_dims=4, cell_size=0.2):
+        self.n_dims = n_dims
+        self.cell_size = cell_size
+        self._cells = {} # cell -> (list of keys, (n, n_dims) array of points)
+        self._key_cells = {} # key -> cell
+        self._neighbour_offsets = {} # radius in cells -> offsets of the cells to search
+
+    def __len__(self):
+        return len(self._key_cells)
+
+    def _offsets(self, radius):
+        if radius not in self._neighbour_offsets:
+            self._neighbour_offsets[radius] = np.array(list(itertools.product(range(-radius, radius + 1), repeat=self.n_dims)))
+        return self._neighbour_offsets[radius]
+
+    def _cell(self, point):
+        return np.floor(np.asarray(point, dtype=np.float64) / self.cell_size).astype(int)
+
+    def insert(self, key, point):
+        cell = tuple(self._cell(point).tolist())
+        point = np.asarray(point, dtype=np.float32).reshape(1, self.n_dims)
+        if cell in self._cells:
+            keys, points = self._cells[cell]
+            self._cells[cell] = (keys + [key], np.concatenate((points, point)))
+        else:
+            self._cells[cell] = ([key], point)
+        self._key_cells[key] = cell
+
+    def remove(self, key):
+        cell = self._key_cells.pop(key, None)
+        if cell is None:
+            return
+        keys, points = self._cells[cell]
+        if len(keys) == 1:
+            del self._cells[cell]
+        else:
+            i = keys.index(key)
+            self._cells[cell] = (keys[:i] + keys[i + 1:], np.delete(points, i, axis=0))
+
+    def clear(self):
+        self._cells.clear()
+        self._key_cells.clear()
+
+    def nearest(self, point, max_distance=None):
+        """
+        Returns (distance, key) of the nearest point within max_distance by L1 distance, searching only the cells
+        that can contain such points, or (inf, None) if there is none. max_distance defaults to cell_size.
+        """
+        if max_distance is None:
+            max_distance = self.cell_size
+        radius = max(1, math.ceil(max_distance / self.cell_size))
+        point = np.asarray(point, dtype=np.float32)
+        # Gather the points of the neighbouring cells (or of every cell, if there are fewer of those),
+        # then compute all of the distances at once
+        if (2 * radius + 1) ** self.n_dims > len(self._cells):
+            cells = list(self._cells)
+        else:
+            cells = map(tuple, (self._cell(point) + self._offsets(radius)).tolist())
+        candidate_keys = []
+        candidate_points = []
+        for cell in cells:
+            entry = self._cells.get(cell)
+            if entry is not None:
+                candidate_keys.extend(entry[0])
+                candidate_points.append(entry[1])
+        if not candidate_points:
+            return np.inf, None
+        distances = np.abs(np.concatenate(candidate_points) - point).sum(axis=1)
+        i = int(np.argmin(distances))
+        if distances[i] > max_distance:
+            return np.inf, None
+        return float(distances[i]), candidate_keys[i]
@@ -0,0 +1,90 @@
+"""
+Between consecutive frames of a live capture the pattern only moves a little, so there is
+no need to search the whole image for it. The tracker remembers where the pattern was last
+found and only searches the area around it.
+"""
+import numpy as np
+
+class RoiTracker:
+    """
+    Restricts detection to the bounding box of the previous frame's corners, expanded by a motion margin.
+    After max_misses consecutive frames without a detection in the region of interest,
+    the tracker forgets the previous corners and the next frame is searched in full.
+    """
+    def __init__(self, margin=0.5, min_margin_px=32, max_misses=3):
+        self.margin = margin # fraction of the bounding box size that the pattern may move between frames
+        self.min_margin_px = min_margin_px
+        self.max_misses = max_misses
+
+        self.last_corners = None
+        self.n_misses = 0
+        self.n_roi_searches = 0
+        self.n_full_searches = 0
+
+    def reset(self):
+        self.last_corners = None
+        self.n_misses = 0
+
+    def roi(self, image_shape):
+        """
+        Returns the region of the image to search as (x0, y0, x1, y1),
+        or None if the full image should be searched.
+        """
+        if self.last_corners is None:
+            return None
+        height, width = image_shape[:2]
+        points = self.last_corners.reshape(-1, 2)
+        x0, y0 = points.min(axis=0)
+        x1, y1 = points.max(axis=0)
+        margin_x = max(self.margin * (x1 - x0), self.min_margin_px)
+        margin_y = max(self.margin * (y1 - y0), self.min_margin_px)
+        x0 = max(int(x0 - margin_x), 0)
+        y0 = max(int(y0 - margin_y), 0)
+        x1 = min(int(np.ceil(x1 + margin_x)), width)
+        y1 = min(int(np.ceil(y1 + margin_y)), height)
+        if x0 == 0 and y0 == 0 and x1 == width and y1 == height:
+            return None # the region covers the whole image anyways
+        return (x0, y0, x1, y1)
+
+    def detect(self, pattern, frame):
+        """
+        Detects the pattern near its previous location in the frame (an ImagePyramid).
+        Returns the same values as Pattern.downsample_and_detect, except that for a search of the region
+        of interest scrib is None unless the frame was already downsampled (eg. by a pre-filter),
+        so that only the region is ever resized or converted.
+        """
+        roi = self.roi(frame.shape)
+        if roi is None:
+            self.n_full_searches += 1
+            scrib, corners, downsampled_corners, scale = pattern.downsample_and_detect(frame)
+        else:
+            self.n_roi_searches += 1
+            x0, y0, x1, y1 = roi
+            # Search the region at the scale that the full frame would be searched at, so that the detector
+            # runs on a small image (the region's share of the detection area), then refine at full resolution
+            height, width = frame.shape[:2]
+            share = ((x1 - x0) * (y1 - y0)) / float(width * height)
+            _, corners, _, _ = pattern.downsample_and_detect(frame.crop(x0, y0, x1, y1),
+                                                             max_area=pattern.max_detection_area * share)
+            scrib = frame.level(pattern.max_detection_area)
+            scale = frame.downsample_scale(pattern.max_detection_area)
+            downsampled_corners = None
+            if corners is not None:
+                corners = corners + np.array([x0, y0], dtype=np.float32)
+                downsampled_corners = corners / np.array(scale, dtype=np.float32)
+
+        self.update(corners)
+        return (scrib, corners, downsampled_corners, scale)
+
+    def update(self, corners):
+        """
+        Records the result of detection in the latest frame (corners is None if the pattern was not found).
+        """
+        if corners is not None:
+            self.last_corners = corners
+            self.n_misses = 0
+        elif self.last_corners is not None:
+            self.n_misses += 1
+            if self.n_misses >= self.max_misses:
+                # the pattern has moved too far (or left the image), so fall back to a full search
+                self.reset()
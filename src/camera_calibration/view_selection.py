@@ -0,0 +1,51 @@
+"""
+After a long session many of the views are redundant, but each of them still adds to the cost of calibrateCamera.
+select_views picks a subset of the views that covers the image, the range of board sizes and the range of tilts
+about as well as all of them, so that the calibration can be solved on the subset only.
+"""
+import numpy as np
+
+def coverage_features(image_points, params, image_size, n_cells=(8, 6), n_bins=8):
+    """
+    Returns an (n_views, n_features) matrix of how much each view covers each feature: the number of its points in
+    each cell of an n_cells (x, y) grid over the image, and (with the same total weight as its points) its bin of
+    board size and of skew (from the view parameters, see calibrator.get_parameters). Views without parameters
+    only cover image cells.
+    """
+    width, height = image_size
+    n_x, n_y = n_cells
+    n_views = len(image_points)
+    features = np.zeros((n_views, n_x * n_y + 2 * n_bins), dtype=np.float64)
+    for i, points in enumerate(image_points):
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        x = np.clip((points[:, 0] * (n_x / width)).astype(np.int64), 0, n_x - 1)
+        y = np.clip((points[:, 1] * (n_y / height)).astype(np.int64), 0, n_y - 1)
+        features[i, :n_x * n_y] = np.bincount(y * n_x + x, minlength=n_x * n_y)
+        if params is not None and not np.isnan(params[i]).any():
+            size_bin = min(int(params[i][2] * n_bins), n_bins - 1)
+            skew_bin = min(int(params[i][3] * n_bins), n_bins - 1)
+            features[i, n_x * n_y + size_bin] = len(points)
+            features[i, n_x * n_y + n_bins + skew_bin] = len(points)
+    return features
+
+def select_views(image_points, params, image_size, max_views, n_cells=(8, 6), n_bins=8):
+    """
+    Greedily selects at most max_views views that maximize the coverage of the image, sizes and skews, and
+    returns their indices (in the order they were added). Each step adds the view with the largest gain, where
+    a feature's contribution is divided by 1 + how much the selected views already cover it, so that views
+    that fill gaps win over views that repeat what is covered already.
+    """
+    n_views = len(image_points)
+    if n_views <= max_views:
+        return list(range(n_views))
+    features = coverage_features(image_points, params, image_size, n_cells, n_bins)
+    covered = np.zeros(features.shape[1], dtype=np.float64)
+    available = np.ones(n_views, dtype=bool)
+    selected = []
+    for _ in range(max_views):
+        gain = np.where(available, features @ (1.0 / (1.0 + covered)), -np.inf)
+        best = int(np.argmax(gain))
+        selected.append(best)
+        available[best] = False
+        covered += features[best]
+    return sorted(selected)
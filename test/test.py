@@ -1,17 +1,22 @@
 import cv2
 from camera_calibration.cli import create_calibrator
 from camera_calibration.sample import MonoSample
+from camera_calibration.scheduler import FrameScheduler
 
 def main():
     print(f"You are using OpenCV version {cv2.__version__}")
     calibrator = create_calibrator()
     cap = cv2.VideoCapture(0)
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        sample = MonoSample(frame)
-        calibrator.maybe_add_sample(sample)
+    # Always process the newest frame, so that latency doesn't build up when detection is slower than the camera
+    scheduler = FrameScheduler(cap.read)
+    with scheduler:
+        for frame, detect in scheduler:
+            sample = MonoSample(frame)
+            if detect:
+                calibrator.maybe_add_sample(sample)
+            elif calibrator.gui is not None:
+                calibrator.gui.show(sample)
+    scheduler.print_stats()
 
     cap.release()
     cv2.destroyAllWindows()